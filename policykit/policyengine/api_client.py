@@ -0,0 +1,129 @@
+"""
+Shared HTTP client for outbound community (Slack Web API) calls.
+
+All calls go through one urllib3 pool per process so connections are kept
+alive and reused instead of paying a TLS handshake per call. Timeouts,
+retries and pool size come from settings. Every call first waits for its
+rate limit group in policyengine.ratelimit, and a 429 is retried after the
+Retry-After Slack sends back.
+"""
+from django.conf import settings
+from contextlib import contextmanager
+from policyengine import metrics, ratelimit
+from urllib.parse import urlencode
+import json
+import logging
+import os
+import threading
+import urllib3
+
+logger = logging.getLogger(__name__)
+
+CONNECT_TIMEOUT = getattr(settings, 'SLACK_API_CONNECT_TIMEOUT', 3.0)
+READ_TIMEOUT = getattr(settings, 'SLACK_API_READ_TIMEOUT', 10.0)
+RETRIES = getattr(settings, 'SLACK_API_RETRIES', 2)
+POOL_SIZE = getattr(settings, 'SLACK_API_POOL_SIZE', 10)
+RATE_LIMIT_RETRIES = getattr(settings, 'SLACK_API_RATE_LIMIT_RETRIES', 5)
+
+
+CALL_SECONDS = metrics.histogram('policykit_slack_api_call_seconds',
+                                 'Slack Web API calls, including rate limit waits and retries',
+                                 ['method'])
+CALL_ERRORS = metrics.counter('policykit_slack_api_errors_total',
+                              'Failed Slack Web API calls by reason: rate_limited, an HTTP status, '
+                              'connection or the error Slack returned',
+                              ['method', 'reason'])
+
+
+class APIError(Exception):
+
+    def __init__(self, url, status, body):
+        super(APIError, self).__init__('%s returned HTTP %s' % (url, status))
+        self.url = url
+        self.status = status
+        self.body = body
+
+
+_lock = threading.Lock()
+_pool = None
+_pool_pid = None
+
+# per thread: the on_first_call callback still waiting for a call
+_first_call = threading.local()
+
+
+@contextmanager
+def on_first_call(callback):
+    """
+    Call callback once, right before the first request this thread sends
+    inside the block; used to record that an event has side effects in
+    Slack that a retry would repeat.
+    """
+    _first_call.callback = callback
+    try:
+        yield
+    finally:
+        _first_call.callback = None
+
+
+def get_pool():
+    global _pool, _pool_pid
+
+    # celery forks its workers, and sockets must not be shared across forks
+    if _pool is None or _pool_pid != os.getpid():
+        with _lock:
+            if _pool is None or _pool_pid != os.getpid():
+                # connection errors are always retried; read errors and bad
+                # statuses only for idempotent methods, so a POST is never
+                # sent twice after it may have reached Slack
+                retries = urllib3.Retry(total=RETRIES, backoff_factor=0.2, raise_on_status=False)
+                _pool = urllib3.PoolManager(maxsize=POOL_SIZE,
+                                            timeout=urllib3.Timeout(connect=CONNECT_TIMEOUT, read=READ_TIMEOUT),
+                                            retries=retries)
+                _pool_pid = os.getpid()
+    return _pool
+
+
+def api_call(url, values, workspace=None):
+    """
+    POST values form-encoded to url and return the decoded JSON response.
+    workspace groups the call with others that share Slack's rate limits.
+    """
+    method = url.rstrip('?').rsplit('/', 1)[-1]
+    with CALL_SECONDS.time(method=method):
+        res = _call(url, method, values, workspace)
+    if not res.get('ok', True):
+        CALL_ERRORS.inc(method=method, reason=res.get('error', 'unknown'))
+    return res
+
+
+def _call(url, method, values, workspace):
+    callback = getattr(_first_call, 'callback', None)
+    if callback is not None:
+        _first_call.callback = None
+        callback()
+
+    bucket = ratelimit.get_bucket(workspace, method)
+
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        bucket.acquire()
+        try:
+            response = get_pool().request('POST', url,
+                                          body=urlencode(values),
+                                          headers={'Content-Type': 'application/x-www-form-urlencoded'})
+        except urllib3.exceptions.HTTPError:
+            CALL_ERRORS.inc(method=method, reason='connection')
+            raise
+        if response.status != 429:
+            break
+
+        # a rate limited request was not processed, so it is safe to resend
+        CALL_ERRORS.inc(method=method, reason='rate_limited')
+        retry_after = float(response.headers.get('Retry-After', 1))
+        logger.warning('%s rate limited for workspace %s, retrying in %ss', method, workspace, retry_after)
+        bucket.block(retry_after)
+
+    if response.status >= 400:
+        CALL_ERRORS.inc(method=method, reason=response.status)
+        raise APIError(url, response.status, response.data)
+    return json.loads(response.data.decode('utf-8'))
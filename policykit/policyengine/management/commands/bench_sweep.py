@@ -0,0 +1,232 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import Group
+from django.db import connection
+from django.test.utils import setup_databases, teardown_databases
+from policyengine import api_client, ratelimit, rules, tasks
+from policyengine.models import ActionPolicy, Policy, RulePolicy, UserVote
+from policykit.celery import app
+from slackintegration.fakeslack import FakeSlack
+from slackintegration.models import SlackIntegration, SlackUser, SlackScheduleMessage
+from contextlib import ExitStack
+from unittest import mock
+import json
+import random
+import threading
+import time
+
+# plain rule that walks every vote, like most hand-written rules do
+VOTE_RULE = """
+yes = len([vote for vote in action.uservote_set.all() if vote.value])
+no = len([vote for vote in action.uservote_set.all() if vote.value is False])
+"""
+
+# structured rule that looks at the votes and never decides
+TALLY_RULE = """
+def check(action, votes):
+    yes = sum(1 for vote in votes if vote.value)
+    return PENDING
+"""
+
+# runs last and passes unanimous actions, which are then executed
+DECIDING_RULE = """
+def check(action, votes):
+    if votes and action.no_votes == 0:
+        return PASS
+    return PENDING
+"""
+
+
+class Timer(object):
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, elapsed):
+        with self.lock:
+            self.count += 1
+            self.time += elapsed
+
+    def wrap(self, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(time.perf_counter() - start)
+        return timed
+
+    def query_wrapper(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.add(time.perf_counter() - start)
+
+
+class Command(BaseCommand):
+    help = ('Time consider_proposed_actions on synthetic communities, actions, votes and rules in a test '
+            'database, and fail if it exceeds the given thresholds')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--communities', type=int, default=5)
+        parser.add_argument('--actions', type=int, default=100,
+                            help='Pending actions per community')
+        parser.add_argument('--rules', type=int, default=5,
+                            help='Passed rules per community')
+        parser.add_argument('--votes', type=int, default=10,
+                            help='Votes per action')
+        parser.add_argument('--pass-rate', type=float, default=0.1,
+                            help='Share of actions with unanimous votes, which pass and are executed')
+        parser.add_argument('--latency-ms', type=float, default=0.0,
+                            help='Latency the fake Slack API adds to every call')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--max-seconds', type=float,
+                            help='Fail if the full sweep takes longer')
+        parser.add_argument('--max-queries-per-community', type=float,
+                            help='Fail if the full sweep needs more queries per community; this must not '
+                                 'grow with --actions or --rules')
+        parser.add_argument('--json', action='store_true',
+                            help='Print the results as JSON')
+
+    def handle(self, *args, **options):
+        old_config = setup_databases(verbosity=0, interactive=False)
+        eager = app.conf.task_always_eager
+        app.conf.task_always_eager = True
+        try:
+            with FakeSlack(latency=options['latency_ms'] / 1000.0) as slack, \
+                    mock.patch.object(ratelimit, 'SHARE', 1000.0), \
+                    mock.patch.object(ratelimit, '_buckets', {}):
+                self.create_data(options)
+                results = self.run_benchmark(options)
+                results['slack_calls'] = dict(slack.calls)
+        finally:
+            app.conf.task_always_eager = eager
+            teardown_databases(old_config, verbosity=0)
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2, sort_keys=True))
+        else:
+            self.report(results)
+
+        failures = []
+        if options['max_seconds'] is not None and results['full']['seconds'] > options['max_seconds']:
+            failures.append('full sweep took %.3fs, more than %ss' % (results['full']['seconds'], options['max_seconds']))
+        limit = options['max_queries_per_community']
+        if limit is not None and results['full']['queries_per_community'] > limit:
+            failures.append('full sweep made %.1f queries per community, more than %s' % (
+                results['full']['queries_per_community'], limit))
+        if failures:
+            raise CommandError('; '.join(failures))
+
+    def create_data(self, options):
+        rng = random.Random(options['seed'])
+        group, _ = Group.objects.get_or_create(name='Slack')
+
+        with ExitStack() as stack:
+            # nothing is evaluated until the benchmark starts
+            stack.enter_context(mock.patch.object(tasks.consider_actions, 'delay'))
+            stack.enter_context(mock.patch.object(tasks.consider_community_actions, 'delay'))
+
+            for c in range(options['communities']):
+                integration = SlackIntegration.objects.create(community_name='bench%s' % c,
+                                                              team_id='TBENCH%s' % c,
+                                                              access_token='xoxb-%s' % c,
+                                                              user_group=group)
+                users = [SlackUser.objects.create(username='UBENCH%s-%s' % (c, u),
+                                                  password='password',
+                                                  community_integration=integration,
+                                                  user_id='UBENCH%s-%s' % (c, u),
+                                                  readable_name='bench',
+                                                  access_token='xoxp-%s-%s' % (c, u))
+                         for u in range(max(options['votes'], 1))]
+
+                actions = []
+                for a in range(options['actions']):
+                    message = SlackScheduleMessage.objects.create(community_integration=integration,
+                                                                  author=users[0],
+                                                                  text='message %s' % a,
+                                                                  channel='C0',
+                                                                  post_at=0)
+                    actions.append(message.action_policy)
+
+                votes = []
+                for action in actions:
+                    unanimous = rng.random() < options['pass_rate']
+                    action_votes = [UserVote(user=user, policy=action, value=unanimous or rng.random() < 0.4)
+                                    for user in users[:options['votes']]]
+                    action.yes_votes = sum(1 for vote in action_votes if vote.value)
+                    action.no_votes = len(action_votes) - action.yes_votes
+                    action.input_version += 1
+                    votes.extend(action_votes)
+                UserVote.objects.bulk_create(votes)
+                Policy.objects.bulk_update(actions, ['yes_votes', 'no_votes'])
+                ActionPolicy.objects.bulk_update(actions, ['input_version'])
+
+                for r in range(options['rules']):
+                    if r == options['rules'] - 1:
+                        code = DECIDING_RULE
+                    else:
+                        code = VOTE_RULE if r % 2 == 0 else TALLY_RULE
+                    rule = RulePolicy.objects.create(community_integration=integration,
+                                                     author=users[0],
+                                                     rule_code=code,
+                                                     explanation='rule %s' % r)
+                    rule.status = Policy.PASSED
+                    rule.save()
+
+    def sweep(self, incremental):
+        queries = Timer()
+        outbound = Timer()
+        timings_before = {t['policy_id']: t['exec_time'] for t in rules.rule_timings()}
+        cache_before = rules.decision_cache_stats()
+
+        with connection.execute_wrapper(queries.query_wrapper), \
+                mock.patch.object(api_client, 'api_call', outbound.wrap(api_client.api_call)):
+            start = time.perf_counter()
+            tasks.consider_proposed_actions(incremental=incremental)
+            elapsed = time.perf_counter() - start
+
+        rule_time = sum(t['exec_time'] - timings_before.get(t['policy_id'], 0.0) for t in rules.rule_timings())
+        cache_after = rules.decision_cache_stats()
+        return {'seconds': elapsed,
+                'queries': queries.count,
+                'query_seconds': queries.time,
+                'rule_seconds': rule_time,
+                'outbound_calls': outbound.count,
+                'outbound_seconds': outbound.time,
+                'decision_cache_hits': cache_after['hits'] - cache_before['hits'],
+                'decision_cache_misses': cache_after['misses'] - cache_before['misses'],
+                }
+
+    def run_benchmark(self, options):
+        pending = ActionPolicy.objects.filter(status=Policy.PROPOSED).count()
+        full = self.sweep(incremental=False)
+        full['actions'] = pending
+        full['queries_per_community'] = full['queries'] / max(options['communities'], 1)
+        passed = pending - ActionPolicy.objects.filter(status=Policy.PROPOSED).count()
+        full['passed'] = passed
+
+        # nothing changed since, so this should do next to nothing
+        incremental = self.sweep(incremental=True)
+
+        return {'parameters': {name: options[name] for name in
+                               ['communities', 'actions', 'rules', 'votes', 'pass_rate', 'latency_ms', 'seed']},
+                'full': full,
+                'incremental': incremental,
+                }
+
+    def report(self, results):
+        parameters = results['parameters']
+        self.stdout.write('%(communities)s communities x %(actions)s actions x %(rules)s rules, %(votes)s votes each' % parameters)
+        for name in ['full', 'incremental']:
+            sweep = results[name]
+            self.stdout.write('%-12s %.3fs: %s queries (%.3fs), rules %.3fs, %s Slack calls (%.3fs), '
+                              'decision cache %s hits / %s misses' % (
+                                  name + ' sweep', sweep['seconds'], sweep['queries'], sweep['query_seconds'],
+                                  sweep['rule_seconds'], sweep['outbound_calls'], sweep['outbound_seconds'],
+                                  sweep['decision_cache_hits'], sweep['decision_cache_misses']))
+        full = results['full']
+        self.stdout.write('%s actions evaluated, %s passed, %.1f queries per community' % (
+            full['actions'], full['passed'], full['queries_per_community']))
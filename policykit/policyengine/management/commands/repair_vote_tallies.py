@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, F, Max, Q
+from policyengine.models import ActionPolicy, Policy, UserVote
+
+
+class Command(BaseCommand):
+    help = 'Recount the vote tallies stored on each policy from the UserVote rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report policies with a wrong tally without fixing them')
+
+    def handle(self, *args, **options):
+        counted = UserVote.objects.values('policy').annotate(
+            yes_votes=Count('pk', filter=Q(value=True)),
+            no_votes=Count('pk', filter=Q(value=False)),
+            abstain_votes=Count('pk', filter=Q(value__isnull=True)),
+            last_vote_time=Max('vote_time'),
+        )
+        counted = {row.pop('policy'): row for row in counted}
+        empty = {'yes_votes': 0, 'no_votes': 0, 'abstain_votes': 0}
+
+        repaired = []
+        stored = Policy.objects.non_polymorphic().values('pk', 'yes_votes', 'no_votes', 'abstain_votes', 'last_vote_time')
+        for policy in stored.iterator():
+            expected = counted.get(policy['pk'], empty)
+            if all(policy[field] == value for field, value in expected.items() if value is not None):
+                continue
+
+            repaired.append(policy['pk'])
+            self.stdout.write('policy %s: stored %s/%s/%s, counted %s/%s/%s' % (
+                policy['pk'],
+                policy['yes_votes'], policy['no_votes'], policy['abstain_votes'],
+                expected['yes_votes'], expected['no_votes'], expected['abstain_votes']))
+            if not options['dry_run']:
+                changes = {field: value for field, value in expected.items() if value is not None}
+                changes['tally_version'] = F('tally_version') + 1
+                Policy.objects.filter(pk=policy['pk']).update(**changes)
+
+        if repaired and not options['dry_run']:
+            # rules may decide differently on the corrected tallies
+            for i in range(0, len(repaired), 500):
+                ActionPolicy.mark_changed(pk__in=repaired[i:i + 500])
+        self.stdout.write('%s policies %s' % (len(repaired), 'to repair' if options['dry_run'] else 'repaired'))
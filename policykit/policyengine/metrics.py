@@ -0,0 +1,363 @@
+"""
+Counters and histograms for the hot paths, in the Prometheus text format.
+
+Metrics are kept in memory by the process that records them. Most of the
+work (event processing, rule evaluation, Slack calls) happens in Celery
+workers rather than in the web process that serves /policyengine/metrics,
+so with POLICYENGINE_METRICS_DIR set every process also writes a snapshot
+of its metrics to that directory every POLICYENGINE_METRICS_FLUSH_SECONDS.
+The endpoint adds up the snapshots of all processes. Snapshots are named by
+pid and process start time, so a reused pid never overwrites an exited
+process's counters. When the endpoint finds the snapshot of a process that
+has exited, it adds its counters and histograms to a single
+metrics-retired.json and removes it, so counters never go backwards and
+the directory does not grow with every recycled worker. The directory must
+not be shared between hosts.
+
+Most gauges are not recorded but computed when the endpoint is scraped, see
+gauge(). Values that only the process doing the work knows, such as how
+many callers wait for a rate limit, are kept with tracked_gauge() instead
+and are summed over processes like counters.
+"""
+from django.conf import settings
+from contextlib import contextmanager
+import atexit
+import fcntl
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+METRICS_DIR = getattr(settings, 'POLICYENGINE_METRICS_DIR', None)
+FLUSH_SECONDS = getattr(settings, 'POLICYENGINE_METRICS_FLUSH_SECONDS', 10)
+
+# seconds; from a fast cache hit to a slow Slack call
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+
+# name -> Counter or Histogram
+_metrics = {}
+
+# name -> (help, function returning the current value)
+_gauges = {}
+
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        # tuple of label values -> count
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        _started()
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def snapshot(self):
+        return [[list(key), value] for key, value in self.values.items()]
+
+    @staticmethod
+    def merge(total, value):
+        return (total or 0) + value
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        _started()
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with _lock:
+            self.values[key] = value
+
+
+class Histogram(object):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # tuple of label values -> [count per bucket..., count, sum]
+        self.values = {}
+
+    def observe(self, value, **labels):
+        _started()
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with _lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        return [[list(key), list(counts)] for key, counts in self.values.items()]
+
+    @staticmethod
+    def merge(total, value):
+        if total is None:
+            return list(value)
+        return [a + b for a, b in zip(total, value)]
+
+
+def _register(metric):
+    with _lock:
+        existing = _metrics.setdefault(metric.name, metric)
+    if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+        raise ValueError('metric %s is already registered differently' % metric.name)
+    return existing
+
+
+def counter(name, help, labelnames=()):
+    return _register(Counter(name, help, labelnames))
+
+
+def histogram(name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return _register(Histogram(name, help, labelnames, buckets))
+
+
+def tracked_gauge(name, help, labelnames=()):
+    return _register(Gauge(name, help, labelnames))
+
+
+def gauge(name, help):
+    """
+    Decorator registering a function as the gauge name. It is called on
+    every scrape and returns the current value.
+    """
+    def register(func):
+        _gauges[name] = (help, func)
+        return func
+    return register
+
+
+def snapshot():
+    with _lock:
+        return {name: metric.snapshot() for name, metric in _metrics.items()}
+
+
+_flusher = None
+
+# pid -> start time, of this process
+_start_times = {}
+
+_snapshot_name = re.compile(r'^metrics-(\d+)-(\w+)\.json$')
+
+RETIRED = 'metrics-retired.json'
+
+
+def _start_time(pid):
+    # clock ticks after boot, from /proc/<pid>/stat; None where there is no /proc
+    try:
+        with open('/proc/%s/stat' % pid) as f:
+            return f.read().rsplit(')', 1)[1].split()[19]
+    except (OSError, IndexError):
+        return None
+
+
+def _snapshot_path(pid):
+    start = _start_times.get(pid)
+    if start is None:
+        start = _start_times[pid] = _start_time(pid) or str(int(time.time() * 1000))
+    return os.path.join(METRICS_DIR, 'metrics-%s-%s.json' % (pid, start))
+
+
+def _alive(pid, start):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    current = _start_time(pid)
+    return current is None or current == start
+
+
+def _merge_snapshots(total, data):
+    # counters and histograms of data added to total; gauges are dropped
+    for name, values in data.items():
+        metric = _metrics.get(name)
+        if metric is None or metric.kind == 'gauge':
+            continue
+        merged = {tuple(key): value for key, value in total.get(name, [])}
+        for key, value in values:
+            key = tuple(key)
+            merged[key] = metric.merge(merged.get(key), value)
+        total[name] = [[list(key), value] for key, value in merged.items()]
+    return total
+
+
+def prune():
+    """
+    Fold the snapshots of exited processes into the retired snapshot.
+    """
+    if not METRICS_DIR or not os.path.isdir(METRICS_DIR):
+        return
+    dead = []
+    for filename in os.listdir(METRICS_DIR):
+        match = _snapshot_name.match(filename)
+        if match and not _alive(int(match.group(1)), match.group(2)):
+            dead.append(os.path.join(METRICS_DIR, filename))
+    if not dead:
+        return
+
+    with open(os.path.join(METRICS_DIR, '.lock'), 'w') as lock:
+        # one process at a time, or a snapshot could be folded in twice
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        retired_path = os.path.join(METRICS_DIR, RETIRED)
+        try:
+            with open(retired_path) as f:
+                retired = json.load(f)
+        except (OSError, ValueError):
+            retired = {}
+        folded = []
+        for path in dead:
+            try:
+                with open(path) as f:
+                    _merge_snapshots(retired, json.load(f))
+            except (OSError, ValueError):
+                # already folded in by another process, or half written
+                continue
+            folded.append(path)
+        with open(retired_path + '.tmp', 'w') as f:
+            json.dump(retired, f)
+        os.replace(retired_path + '.tmp', retired_path)
+        for path in folded:
+            os.remove(path)
+
+
+def flush():
+    if not METRICS_DIR:
+        return
+    path = _snapshot_path(os.getpid())
+    with open(path + '.tmp', 'w') as f:
+        json.dump(snapshot(), f)
+    os.replace(path + '.tmp', path)
+
+
+def _flush_forever():
+    while True:
+        time.sleep(FLUSH_SECONDS)
+        try:
+            flush()
+        except OSError:
+            pass
+
+
+def _started():
+    # start the flush thread in the process that records metrics, which
+    # after a fork is not the one that imported this module
+    global _flusher
+
+    if not METRICS_DIR or _flusher == os.getpid():
+        return
+    with _lock:
+        if _flusher != os.getpid():
+            if _flusher is not None:
+                # forked: what was recorded so far is in the parent's snapshot
+                for metric in _metrics.values():
+                    metric.values.clear()
+            _flusher = os.getpid()
+            threading.Thread(target=_flush_forever, daemon=True).start()
+            atexit.register(flush)
+
+
+def collect():
+    """
+    Metrics of this process plus the latest snapshots of all others, as
+    {name: {label values: value}}. Gauges only count snapshots that are
+    still being refreshed: an exited process's last value is stale.
+    """
+    # (metrics, from a live process)
+    snapshots = [(snapshot(), True)]
+    if METRICS_DIR and os.path.isdir(METRICS_DIR):
+        try:
+            prune()
+        except OSError:
+            logger.exception('could not prune metric snapshots in %s', METRICS_DIR)
+        own = os.path.basename(_snapshot_path(os.getpid()))
+        now = time.time()
+        for filename in os.listdir(METRICS_DIR):
+            if filename == own or not filename.endswith('.json'):
+                continue
+            path = os.path.join(METRICS_DIR, filename)
+            try:
+                live = now - os.path.getmtime(path) < 3 * FLUSH_SECONDS
+                with open(path) as f:
+                    snapshots.append((json.load(f), live))
+            except (OSError, ValueError):
+                continue
+
+    totals = {}
+    for data, live in snapshots:
+        for name, values in data.items():
+            metric = _metrics.get(name)
+            if metric is None or (metric.kind == 'gauge' and not live):
+                continue
+            merged = totals.setdefault(name, {})
+            for key, value in values:
+                key = tuple(key)
+                merged[key] = metric.merge(merged.get(key), value)
+    return totals
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = ('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in pairs)
+    return '{%s}' % ','.join(escaped)
+
+
+def render():
+    """
+    All metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    totals = collect()
+    for name in sorted(_metrics):
+        metric = _metrics[name]
+        lines.append('# HELP %s %s' % (name, metric.help))
+        lines.append('# TYPE %s %s' % (name, metric.kind))
+        for key, value in sorted(totals.get(name, {}).items()):
+            if metric.kind != 'histogram':
+                lines.append('%s%s %s' % (name, _labels(metric.labelnames, key), value))
+                continue
+            for bound, count in zip(metric.buckets + ('+Inf',), value):
+                lines.append('%s_bucket%s %s' % (name, _labels(metric.labelnames, key, [('le', bound)]), count))
+            lines.append('%s_count%s %s' % (name, _labels(metric.labelnames, key), value[-2]))
+            lines.append('%s_sum%s %s' % (name, _labels(metric.labelnames, key), value[-1]))
+
+    for name in sorted(_gauges):
+        help, func = _gauges[name]
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s gauge' % name)
+        lines.append('%s %s' % (name, func()))
+    return '\n'.join(lines) + '\n'
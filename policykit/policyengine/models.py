@@ -1,11 +1,22 @@
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import F
+from django.utils import timezone
 from django.contrib.auth.models import User, Group, Permission
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
 # from django.contrib.govinterface.models import LogEntry
 from polymorphic.models import PolymorphicModel
 from django.core.exceptions import ValidationError
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from policyengine.views import *
+from policyengine import api_client, metrics, permissions, rules
+from datetime import timedelta
+
+
+# marks the absence of a vote, since a vote value of None is an abstention
+NO_VOTE = object()
 
 
 class CommunityIntegration(PolymorphicModel):
@@ -29,21 +40,17 @@ class CommunityUser(User, PolymorphicModel):
                                      unique=True)
     
         
+    PERMISSIONS = ['Can add process',
+                   'Can add rule',
+                   'Can add user vote',
+                   'Can change user vote',
+                   'Can delete user vote',
+                   'Can view user vote']
+        
     def save(self, *args, **kwargs):      
         super(User, self).save(*args, **kwargs)
-        p1 = Permission.objects.get(name='Can add process')
-        p2 = Permission.objects.get(name='Can add rule')
-        self.user_permissions.add(p1)
-        self.user_permissions.add(p2)
-        
-        p3 = Permission.objects.get(name='Can add user vote')
-        p4 = Permission.objects.get(name='Can change user vote')
-        p5 = Permission.objects.get(name='Can delete user vote')
-        p6 = Permission.objects.get(name='Can view user vote')
-        self.user_permissions.add(p3)
-        self.user_permissions.add(p4)
-        self.user_permissions.add(p5)
-        self.user_permissions.add(p6)
+        # add() only inserts the permissions the user does not have yet
+        self.user_permissions.add(*permissions.get_permission_ids('name', CommunityUser.PERMISSIONS))
         
     def __str__(self):
         return self.readable_name + '@' + self.community_integration.community_name
@@ -63,18 +70,25 @@ class CommunityAction(PolymorphicModel):
     community_post_id = models.CharField('community_post_id', 
                                          max_length=300)
     
+    # the ActionPolicy created for this action, so votes on the rule post
+    # find it without a generic relation lookup
+    action_policy = models.OneToOneField('ActionPolicy',
+                                         models.SET_NULL,
+                                         null=True,
+                                         blank=True,
+                                         related_name='community_action')
+    
+    class Meta:
+        indexes = [
+            # reaction_added looks actions up by the rule post they got
+            models.Index(fields=['community_integration', 'community_post_id']),
+        ]
+    
     
     def api_call(self, values, call):
-        logger.info("COMMUNITY ACTION API CALL")
-        logger.info(call)
-        data = urllib.parse.urlencode(values)
-        data = data.encode('utf-8')
-        call_info = call + '?'
-        req = urllib.request.Request(call_info, data)
-        resp = urllib.request.urlopen(req)
-        res = json.loads(resp.read().decode('utf-8'))
-        logger.info("COMMUNITY ACTION API RESPONSE")
-        logger.info(res)
+        res = api_client.api_call(call, values, workspace=self.community_integration_id)
+        logger.debug('%s for workspace %s: %s', call.rsplit('/', 1)[-1], self.community_integration_id,
+                     'ok' if res.get('ok') else res.get('error'))
         return res
     
     def revert(self, values, call):
@@ -93,8 +107,6 @@ class CommunityAction(PolymorphicModel):
             self.community_post_id = res['ts']         
             
     def save(self, *args, **kwargs):
-        logger.info(self.community_post_id)
-        
         if not self.pk:
             # Runs only when object is new
             super(CommunityAction, self).save(*args, **kwargs)
@@ -105,6 +117,8 @@ class CommunityAction(PolymorphicModel):
                                                       object_id=self.id,
                                                       action=ActionPolicy.ADD,
                                                       )
+            CommunityAction.objects.filter(pk=self.pk).update(action_policy=action_policy)
+            self.action_policy = action_policy
 
         else:   
             super(CommunityAction, self).save(*args, **kwargs) 
@@ -137,6 +151,42 @@ class Policy(PolymorphicModel):
     
     status = models.CharField(choices=STATUS, max_length=10)
     
+    # denormalized from UserVote so rules can read the tally without a query;
+    # only update_tally writes these, repair_vote_tallies rebuilds them
+    yes_votes = models.PositiveIntegerField(default=0)
+    no_votes = models.PositiveIntegerField(default=0)
+    abstain_votes = models.PositiveIntegerField(default=0)
+    last_vote_time = models.DateTimeField(null=True, blank=True)
+    # bumped on every tally change; part of the key rule decisions are cached by
+    tally_version = models.PositiveIntegerField(default=0)
+    
+    TALLY_FIELDS = {True: 'yes_votes', False: 'no_votes', None: 'abstain_votes'}
+    
+    # columns changed only through update(), which save() leaves alone
+    UPDATE_ONLY_FIELDS = list(TALLY_FIELDS.values()) + ['last_vote_time', 'tally_version']
+    
+    def save(self, *args, **kwargs):
+        # never write back a stale copy of the tally over concurrent votes
+        if self.pk and not args and not kwargs.get('update_fields') and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields
+                                       if not f.primary_key and f.name not in self.UPDATE_ONLY_FIELDS]
+        super(Policy, self).save(*args, **kwargs)
+    
+    @staticmethod
+    def update_tally(policy_id, added, removed, vote_time=None):
+        # added and removed are vote values or NO_VOTE; applied with F() so
+        # concurrent votes cannot lose updates
+        changes = {'tally_version': F('tally_version') + 1}
+        if vote_time:
+            changes['last_vote_time'] = vote_time
+        if added is not NO_VOTE:
+            field = Policy.TALLY_FIELDS[added]
+            changes[field] = F(field) + 1
+        if removed is not NO_VOTE:
+            field = Policy.TALLY_FIELDS[removed]
+            changes[field] = changes.get(field, F(field)) - 1
+        Policy.objects.filter(pk=policy_id).update(**changes)
+    
     
 class ProcessPolicy(Policy):    
     process_code = models.TextField()
@@ -183,7 +233,9 @@ class RulePolicy(Policy):
             super(RulePolicy, self).save(*args, **kwargs)
             
             if process.exists():
-                exec(process[0].process_code)
+                process = process[0]
+                rules.exec_policy_code(process, process.process_code, globals(),
+                                       {'self': self, 'process': process})
 
         else:   
             super(RulePolicy, self).save(*args, **kwargs)
@@ -212,10 +264,31 @@ class ActionPolicy(Policy):
     
     action = models.CharField(choices=ACTIONS, max_length=10)
     
+    # the action needs evaluating whenever input_version is ahead of
+    # evaluated_version (a vote or a rule changed) or evaluate_at has passed
+    input_version = models.PositiveIntegerField(default=1)
+    evaluated_version = models.PositiveIntegerField(default=0)
+    evaluate_at = models.DateTimeField(null=True, blank=True)
+    
+    # held by whoever is evaluating the action so it is never evaluated twice
+    # at the same time; expired leases can be taken over
+    lease_owner = models.CharField(max_length=32, blank=True)
+    lease_expires = models.DateTimeField(null=True, blank=True)
+    
+    LEASE = timedelta(seconds=getattr(settings, 'POLICYENGINE_LEASE_SECONDS', 300))
+    
+    # a save from rule code or the admin must not undo a concurrent vote's
+    # input_version bump or another worker's lease
+    UPDATE_ONLY_FIELDS = Policy.UPDATE_ONLY_FIELDS + ['input_version', 'evaluated_version', 'evaluate_at',
+                                                      'lease_owner', 'lease_expires']
+    
     
     class Meta:
         verbose_name = 'action'
         verbose_name_plural = 'actions'
+        indexes = [
+            models.Index(fields=['content_type', 'object_id']),
+        ]
 
     def __str__(self):
         return ' '.join(['Action: ', self.action, str(self.content_type), 'to', self.community_integration.community_name])
@@ -224,17 +297,70 @@ class ActionPolicy(Policy):
         if not self.pk:
             # Runs only when object is new
             self.status = Policy.PROPOSED
+            self.lease_expires = timezone.now() + ActionPolicy.LEASE
             
             super(ActionPolicy, self).save(*args, **kwargs)
             
-            action = self
-            for rule in RulePolicy.objects.filter(status=Policy.PASSED, community_integration=self.community_integration):
-                exec(rule.rule_code)
+            community_rules = RulePolicy.objects.filter(status=Policy.PASSED, community_integration=self.community_integration)
+            decision, rule = rules.evaluate_action(self, community_rules, globals(), {'self': self})
+            if decision != rules.PENDING:
+                ActionPolicy.apply_decisions([(self, decision, rule)])
+            self.mark_evaluated()
+            
+            if self.evaluate_at:
+                from policyengine.tasks import schedule_deadlines
+                deadlines = [(self.pk, self.evaluate_at)]
+                transaction.on_commit(lambda: schedule_deadlines(deadlines))
 
         else:   
             super(ActionPolicy, self).save(*args, **kwargs)
+            
+    def reevaluate_at(self, when):
+        # called from rule code that depends on time rather than on votes;
+        # the flag keeps the answer of the rule out of the decision cache
+        self.reevaluate_requested = True
+        if self.evaluate_at is None or when < self.evaluate_at:
+            self.evaluate_at = when
+            
+    def mark_evaluated(self):
+        ActionPolicy.objects.filter(pk=self.pk).update(evaluated_version=self.input_version,
+                                                       evaluate_at=self.evaluate_at,
+                                                       lease_expires=None)
+        self.evaluated_version = self.input_version
+        self.lease_expires = None
+        
+    @staticmethod
+    def mark_all_evaluated(actions):
+        for action in actions:
+            action.evaluated_version = action.input_version
+            action.lease_expires = None
+        ActionPolicy.objects.bulk_update(actions, ['evaluated_version', 'evaluate_at', 'lease_expires'])
+    
+    @staticmethod
+    def apply_decisions(decisions):
+        # decisions are (action, result, rule) from rules.evaluate_action
+        failed = [action for action, result, rule in decisions if result == rules.FAIL]
+        if failed:
+            ActionPolicy.objects.filter(pk__in=[action.pk for action in failed]).update(status=Policy.FAILED)
+            for action in failed:
+                action.status = Policy.FAILED
         
+        execute_actions([action for action, result, rule in decisions if result == rules.PASS])
+        
+        for action, result, rule in decisions:
+            rules.notify(rule, action, result, globals())
+    
+    @staticmethod
+    def mark_changed(**filters):
+        ActionPolicy.objects.filter(status=Policy.PROPOSED, **filters).update(input_version=F('input_version') + 1)
         
+        
+
+VOTES = metrics.counter('policykit_votes_total',
+                        'Votes cast or changed',
+                        ['value'])
+VOTE_LABELS = {True: 'yes', False: 'no', None: 'abstain'}
+
 
 class UserVote(models.Model):
     
@@ -246,6 +372,61 @@ class UserVote(models.Model):
     
     value = models.BooleanField(null=True)
     
+    vote_time = models.DateTimeField(auto_now=True, null=True)
     
-    
-    
\ No newline at end of file
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            previous_policy_id, previous = self.policy_id, NO_VOTE
+            if self.pk:
+                stored = UserVote.objects.select_for_update().filter(pk=self.pk).values_list('policy_id', 'value').first()
+                if stored is not None:
+                    previous_policy_id, previous = stored
+            super(UserVote, self).save(*args, **kwargs)
+            if previous_policy_id != self.policy_id:
+                # the vote was moved to another policy, e.g. in the admin
+                Policy.update_tally(previous_policy_id, NO_VOTE, previous)
+                Policy.update_tally(self.policy_id, self.value, NO_VOTE, self.vote_time)
+                VOTES.inc(value=VOTE_LABELS[self.value])
+                self._moved_from = previous_policy_id
+            elif previous != self.value or previous is NO_VOTE:
+                Policy.update_tally(self.policy_id, self.value, previous, self.vote_time)
+                VOTES.inc(value=VOTE_LABELS[self.value])
+            else:
+                Policy.objects.filter(pk=self.policy_id).update(last_vote_time=self.vote_time)
+
+
+@receiver(post_save, sender=ProcessPolicy)
+@receiver(post_save, sender=RulePolicy)
+@receiver(post_delete, sender=ProcessPolicy)
+@receiver(post_delete, sender=RulePolicy)
+def invalidate_compiled_code(sender, instance, **kwargs):
+    rules.invalidate(instance.pk)
+
+
+@receiver(post_save, sender=RulePolicy)
+@receiver(post_delete, sender=RulePolicy)
+def rule_changed(sender, instance, **kwargs):
+    from policyengine.tasks import consider_community_actions
+    
+    community_id = instance.community_integration_id
+    ActionPolicy.mark_changed(community_integration=community_id)
+    transaction.on_commit(lambda: consider_community_actions.delay(community_id))
+
+
+@receiver(post_save, sender=UserVote)
+@receiver(post_delete, sender=UserVote)
+def vote_changed(sender, instance, **kwargs):
+    from policyengine.tasks import consider_actions
+    
+    policy_ids = [instance.policy_id]
+    moved_from = instance.__dict__.pop('_moved_from', None)
+    if moved_from is not None:
+        policy_ids.append(moved_from)
+    ActionPolicy.mark_changed(pk__in=policy_ids)
+    # evaluate as soon as the vote is committed rather than at the next sweep
+    transaction.on_commit(lambda: consider_actions.delay(policy_ids))
+
+
+@receiver(post_delete, sender=UserVote)
+def vote_deleted(sender, instance, **kwargs):
+    Policy.update_tally(instance.policy_id, NO_VOTE, instance.value)
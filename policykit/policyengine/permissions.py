@@ -0,0 +1,37 @@
+"""
+Process-level cache of permission ids.
+
+Users and groups are given the same fixed permissions over and over (on
+every login and every integration save), so the ids are looked up once per
+process and reused. The cache is cleared whenever migrations run, since
+that is when permissions are created or removed.
+"""
+from django.contrib.auth.models import Permission
+from django.db.models.signals import post_migrate
+from django.dispatch import receiver
+import threading
+
+_lock = threading.Lock()
+
+# (field, values) -> list of permission ids
+_ids = {}
+
+
+def get_permission_ids(field, values):
+    """
+    Ids of the permissions whose field is one of values, e.g.
+    get_permission_ids('codename', ['add_rulepolicy']).
+    """
+    key = (field, tuple(values))
+    ids = _ids.get(key)
+    if ids is None:
+        ids = list(Permission.objects.filter(**{field + '__in': values}).values_list('pk', flat=True))
+        with _lock:
+            _ids[key] = ids
+    return ids
+
+
+@receiver(post_migrate)
+def clear_permission_ids(**kwargs):
+    with _lock:
+        _ids.clear()
@@ -0,0 +1,126 @@
+"""
+Opt-in SQL profiling of requests and Celery tasks.
+
+With POLICYENGINE_PROFILE_SQL on, every request that goes through
+SQLProfilerMiddleware and every Celery task records how many queries it
+ran, how long they took, and how often each query shape (the SQL with
+literals and IN lists folded, see fingerprint()) was repeated. Requests and
+tasks over one of the thresholds are logged as warnings together with
+their most repeated queries. The same query shape run many times is the
+usual sign of an N+1, e.g. a polymorphic lookup or a __str__ following
+community_integration inside a loop.
+
+With POLICYENGINE_PROFILE_HEADER on, responses also carry the numbers in
+an X-SQL-Profile header.
+"""
+from celery.signals import task_prerun, task_postrun
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from collections import Counter
+import logging
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+ENABLED = getattr(settings, 'POLICYENGINE_PROFILE_SQL', False)
+MAX_QUERIES = getattr(settings, 'POLICYENGINE_PROFILE_MAX_QUERIES', 50)
+MAX_SQL_SECONDS = getattr(settings, 'POLICYENGINE_PROFILE_MAX_SQL_SECONDS', 0.5)
+MAX_REPEATS = getattr(settings, 'POLICYENGINE_PROFILE_MAX_REPEATS', 10)
+HEADER = getattr(settings, 'POLICYENGINE_PROFILE_HEADER', False)
+
+_in_list = re.compile(r'\((?:\s*%s\s*,)+\s*%s\s*\)')
+_string = re.compile(r"'(?:[^']|'')*'")
+_number = re.compile(r'\b\d+(?:\.\d+)?\b')
+
+
+def fingerprint(sql):
+    sql = _in_list.sub('(...)', sql)
+    sql = _string.sub('?', sql)
+    return _number.sub('?', sql)
+
+
+class QueryProfile(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.time = 0.0
+        self.fingerprints = Counter()
+        self.start = time.perf_counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.time += time.perf_counter() - start
+            self.fingerprints[fingerprint(sql)] += 1
+
+    def install(self):
+        for connection in connections.all():
+            connection.execute_wrappers.append(self)
+
+    def uninstall(self):
+        for connection in connections.all():
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+
+    def repeated(self):
+        return [(sql, count) for sql, count in self.fingerprints.most_common(5) if count > 1]
+
+    def over_threshold(self):
+        return (self.count > MAX_QUERIES or
+                self.time > MAX_SQL_SECONDS or
+                any(count > MAX_REPEATS for sql, count in self.repeated()))
+
+    def summary(self):
+        return '%s queries, %.1fms SQL' % (self.count, self.time * 1000)
+
+    def report(self):
+        if not self.over_threshold():
+            return
+        elapsed = time.perf_counter() - self.start
+        logger.warning('%s: %s in %.1fms%s', self.name, self.summary(), elapsed * 1000,
+                       ''.join('\n  %sx %s' % (count, sql[:300]) for sql, count in self.repeated()))
+
+
+class SQLProfilerMiddleware(object):
+
+    def __init__(self, get_response):
+        if not ENABLED:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        profile = QueryProfile('%s %s' % (request.method, request.path))
+        profile.install()
+        try:
+            response = self.get_response(request)
+        finally:
+            profile.uninstall()
+        profile.report()
+        if HEADER:
+            response['X-SQL-Profile'] = profile.summary()
+        return response
+
+
+# task id -> QueryProfile
+_task_profiles = {}
+
+
+@task_prerun.connect
+def start_task_profile(task_id=None, task=None, **kwargs):
+    if ENABLED:
+        profile = _task_profiles[task_id] = QueryProfile('task %s' % task.name)
+        profile.install()
+
+
+@task_postrun.connect
+def finish_task_profile(task_id=None, **kwargs):
+    profile = _task_profiles.pop(task_id, None)
+    if profile is not None:
+        profile.uninstall()
+        profile.report()
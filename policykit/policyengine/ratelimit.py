@@ -0,0 +1,164 @@
+"""
+Outbound request scheduler for the Slack Web API rate limits.
+
+Calls are grouped by (workspace, method tier) and each group draws from a
+token bucket sized to its Slack tier. A caller that finds its bucket empty
+waits for a token instead of sending a request that would be answered with
+a 429, and a 429's Retry-After pauses the whole group. Buckets live in the
+current process, so SLACK_RATE_LIMIT_SHARE lets each process take only
+its part of the limit when several workers talk to the same workspace.
+"""
+from django.conf import settings
+from policyengine import metrics
+import threading
+import time
+
+# requests per minute for each Slack tier
+TIER_LIMITS = {
+    1: 1,
+    2: 20,
+    3: 50,
+    4: 100,
+    # chat.postMessage is limited to about one message per second
+    'post': 60,
+}
+
+METHOD_TIERS = {
+    'chat.postMessage': 'post',
+    'chat.delete': 3,
+    'chat.scheduleMessage': 3,
+    'conversations.info': 3,
+    'conversations.rename': 2,
+    'conversations.kick': 3,
+    'conversations.invite': 3,
+    'pins.add': 2,
+    'pins.remove': 2,
+    'users.identity': 4,
+    'oauth.v2.access': 4,
+}
+
+DEFAULT_TIER = 3
+
+SHARE = getattr(settings, 'SLACK_RATE_LIMIT_SHARE', 1.0)
+
+QUEUE_DEPTH = metrics.tracked_gauge('policykit_slack_rate_limit_waiting',
+                                    'Slack API calls waiting for their rate limit', ['tier'])
+WAIT_SECONDS = metrics.histogram('policykit_slack_rate_limit_wait_seconds',
+                                 'Time Slack API calls waited for their rate limit', ['tier'])
+RATE_LIMITED = metrics.counter('policykit_slack_rate_limit_pauses_total',
+                               'Rate limit groups paused by a 429 from Slack', ['tier'])
+
+
+class TokenBucket(object):
+
+    def __init__(self, per_minute, tier=None):
+        self.tier = tier
+        self.rate = per_minute * SHARE / 60.0
+        self.capacity = max(1.0, per_minute * SHARE / 10.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+        # metrics
+        self.waiting = 0
+        self.acquired = 0
+        self.waited = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.rate_limited = 0
+
+    def _refill(self, now):
+        # nothing accumulates while the group is paused by a 429
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def acquire(self):
+        """
+        Take a token, sleeping until one is available. Returns the time
+        spent waiting.
+        """
+        start = time.monotonic()
+        queued = False
+        try:
+            while True:
+                with self.lock:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if now >= self.blocked_until and self.tokens >= 1:
+                        self.tokens -= 1
+                        waited = now - start
+                        self.acquired += 1
+                        if queued:
+                            self.waited += 1
+                            self.wait_time += waited
+                            self.max_wait_time = max(self.max_wait_time, waited)
+                        WAIT_SECONDS.observe(waited, tier=self.tier)
+                        return waited
+
+                    if not queued:
+                        queued = True
+                        self.waiting += 1
+                        QUEUE_DEPTH.inc(tier=self.tier)
+                    delay = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+                time.sleep(delay)
+        finally:
+            if queued:
+                with self.lock:
+                    self.waiting -= 1
+                QUEUE_DEPTH.dec(tier=self.tier)
+
+    def block(self, seconds):
+        # Slack asked us to back off; nothing in this group goes out until then
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.rate_limited += 1
+            RATE_LIMITED.inc(tier=self.tier)
+            self.blocked_until = max(self.blocked_until, now + seconds)
+            # let a single request through once the pause is over
+            self.tokens = min(self.tokens, 1)
+            self.updated = self.blocked_until
+
+    def stats(self):
+        with self.lock:
+            return {'queue_depth': self.waiting,
+                    'acquired': self.acquired,
+                    'waited': self.waited,
+                    'wait_time': self.wait_time,
+                    'max_wait_time': self.max_wait_time,
+                    'rate_limited': self.rate_limited,
+                    }
+
+
+_lock = threading.Lock()
+
+# (workspace, tier) -> TokenBucket
+_buckets = {}
+
+
+def method_tier(method):
+    return METHOD_TIERS.get(method, DEFAULT_TIER)
+
+
+def get_bucket(workspace, method):
+    key = (workspace, method_tier(method))
+    bucket = _buckets.get(key)
+    if bucket is None:
+        with _lock:
+            bucket = _buckets.get(key)
+            if bucket is None:
+                bucket = _buckets[key] = TokenBucket(TIER_LIMITS[key[1]], key[1])
+    return bucket
+
+
+def stats():
+    """
+    Queue depth and wait time metrics for each (workspace, tier) group of
+    this process. /policyengine/metrics has the same numbers per tier, summed
+    over all processes.
+    """
+    with _lock:
+        buckets = list(_buckets.items())
+    return {key: bucket.stats() for key, bucket in buckets}
@@ -0,0 +1,269 @@
+"""
+Compilation cache and evaluation of rule and process code.
+
+RulePolicy.rule_code and ProcessPolicy.process_code are compiled once per
+(policy id, content hash) and the resulting code objects are reused for every
+evaluation. Compile and execution times are tracked per policy so slow rules
+can be found from the logs or from rule_timings(). With
+POLICYENGINE_SANDBOX_RULES on, the code runs in policyengine.sandbox instead
+of in this process.
+
+A rule can be written in one of two ways. It can be a plain block of code
+that is exec'd with `action` in scope and acts on it itself, for example by
+calling execute_action(action). Or it can define functions:
+
+    def check(action, votes):
+        # votes are the action's UserVotes, already loaded
+        if action.yes_votes > action.no_votes:
+            return PASS
+        return PENDING
+
+    def notify(action, result):
+        ...
+
+check returns PASS, FAIL or PENDING and must not change anything itself.
+The engine applies the decisions (see ActionPolicy.apply_decisions) and then
+calls notify, if the rule has one, for every decided action.
+
+Because check only looks at the action and its votes, its answer is cached
+by (rule id, rule hash, action id, tally version) and not asked again until
+a vote or the rule changes. A check that depends on time must call
+action.reevaluate_at(); its answer is then never cached.
+"""
+from django.conf import settings
+from policyengine import metrics, sandbox
+from policyengine.cache import LRUCache
+import ast
+import hashlib
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SLOW_RULE_SECONDS = getattr(settings, 'POLICYENGINE_SLOW_RULE_SECONDS', 0.5)
+DECISION_CACHE_SIZE = getattr(settings, 'POLICYENGINE_DECISION_CACHE_SIZE', 10000)
+
+PASS = 'passed'
+FAIL = 'failed'
+PENDING = 'pending'
+
+
+class RuleTiming(object):
+
+    def __init__(self, policy_id):
+        self.policy_id = policy_id
+        self.compile_count = 0
+        self.compile_time = 0.0
+        self.exec_count = 0
+        self.exec_time = 0.0
+        self.max_exec_time = 0.0
+
+    def as_dict(self):
+        return {'policy_id': self.policy_id,
+                'compile_count': self.compile_count,
+                'compile_time': self.compile_time,
+                'exec_count': self.exec_count,
+                'exec_time': self.exec_time,
+                'max_exec_time': self.max_exec_time,
+                }
+
+
+class CompiledPolicy(object):
+
+    def __init__(self, digest, code, structured):
+        self.digest = digest
+        self.code = code
+        # defines check(); its functions are built on first use
+        self.structured = structured
+        self.functions = None
+
+
+_lock = threading.Lock()
+
+EXEC_SECONDS = metrics.histogram('policykit_policy_exec_seconds',
+                                 'Execution time of rule and process code, per policy',
+                                 ['policy'])
+
+CACHE_LOOKUPS = metrics.counter('policykit_decision_cache_lookups_total',
+                                'Lookups of cached check() results', ['result'])
+CACHE_ENTRIES = metrics.tracked_gauge('policykit_decision_cache_entries',
+                                      'check() results held in the decision cache')
+
+# policy id -> CompiledPolicy
+_compiled = {}
+
+# policy id -> RuleTiming
+_timings = {}
+
+# (rule id, digest, action id, tally version) -> result of check
+_decisions = LRUCache(DECISION_CACHE_SIZE)
+
+
+def _digest(source):
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+def _timing(policy_id):
+    timing = _timings.get(policy_id)
+    if timing is None:
+        timing = _timings.setdefault(policy_id, RuleTiming(policy_id))
+    return timing
+
+
+def _defines_check(tree):
+    return any(isinstance(node, ast.FunctionDef) and node.name == 'check' for node in tree.body)
+
+
+def get_compiled(policy, source):
+    """
+    Return the CompiledPolicy for source, compiling it only if this policy
+    has not been compiled before or its code has changed since.
+    """
+    digest = _digest(source)
+    entry = _compiled.get(policy.pk)
+    if entry is not None and entry.digest == digest:
+        return entry
+
+    start = time.perf_counter()
+    tree = ast.parse(source, '<policy %s>' % policy.pk)
+    entry = CompiledPolicy(digest, compile(tree, '<policy %s>' % policy.pk, 'exec'), _defines_check(tree))
+    elapsed = time.perf_counter() - start
+
+    with _lock:
+        _compiled[policy.pk] = entry
+        timing = _timing(policy.pk)
+        timing.compile_count += 1
+        timing.compile_time += elapsed
+
+    logger.debug('compiled policy %s in %.6fs', policy.pk, elapsed)
+    return entry
+
+
+def compile_policy_code(policy, source):
+    return get_compiled(policy, source).code
+
+
+def _record_exec(policy, start):
+    elapsed = time.perf_counter() - start
+    with _lock:
+        timing = _timing(policy.pk)
+        timing.exec_count += 1
+        timing.exec_time += elapsed
+        timing.max_exec_time = max(timing.max_exec_time, elapsed)
+    EXEC_SECONDS.observe(elapsed, policy=policy.pk)
+
+    if elapsed > SLOW_RULE_SECONDS:
+        logger.warning('slow policy %s took %.3fs', policy.pk, elapsed)
+
+
+def exec_policy_code(policy, source, globals_, locals_):
+    """
+    Execute the compiled source of policy the same way exec(source) would in
+    the calling frame, with the caller's globals and the given locals.
+    """
+    start = time.perf_counter()
+    try:
+        if sandbox.ENABLED:
+            try:
+                sandbox.run_policy_code(policy, _digest(source), source, locals_)
+            except sandbox.SandboxError as e:
+                # a broken rule only fails itself
+                logger.error('policy %s failed in the sandbox: %s', policy.pk, e)
+        else:
+            exec(compile_policy_code(policy, source), globals_, locals_)
+    finally:
+        _record_exec(policy, start)
+
+
+def get_rule_functions(rule, globals_):
+    """
+    (check, notify) defined by a structured rule, built once per compiled
+    version of the rule.
+    """
+    entry = get_compiled(rule, rule.rule_code)
+    if entry.functions is None:
+        namespace = dict(globals_, PASS=PASS, FAIL=FAIL, PENDING=PENDING)
+        exec(entry.code, namespace)
+        entry.functions = (namespace['check'], namespace.get('notify'))
+    return entry.functions
+
+
+def run_check(rule, action, votes, globals_):
+    start = time.perf_counter()
+    try:
+        if sandbox.ENABLED:
+            try:
+                return sandbox.run_policy_code(rule, _digest(rule.rule_code), rule.rule_code,
+                                               {'action': action, 'rule': rule}, call='check')
+            except sandbox.SandboxError as e:
+                logger.error('policy %s failed in the sandbox: %s', rule.pk, e)
+                return PENDING
+        check, _ = get_rule_functions(rule, globals_)
+        return check(action, votes)
+    finally:
+        _record_exec(rule, start)
+
+
+def evaluate_action(action, action_rules, globals_, locals_=None):
+    """
+    Run the passed rules of a community against one of its actions and
+    return (decision, rule). Structured rules are asked for a decision and
+    the first PASS or FAIL wins; plain rules are exec'd with locals_ and act
+    on the action themselves. A rule that raises is logged and skipped, the
+    same way a rule failing in the sandbox is.
+    """
+    votes = None
+    for rule in action_rules:
+        if not rule.rule_code:
+            # rules written only as text have nothing to run
+            continue
+        try:
+            entry = get_compiled(rule, rule.rule_code)
+            if entry.structured:
+                key = (rule.pk, entry.digest, action.pk, action.tally_version)
+                result = _decisions.get(key)
+                CACHE_LOOKUPS.inc(result='miss' if result is None else 'hit')
+                if result is None:
+                    if votes is None:
+                        votes = list(action.uservote_set.all())
+                    action.reevaluate_requested = False
+                    result = run_check(rule, action, votes, globals_)
+                    if not action.reevaluate_requested:
+                        _decisions.set(key, result)
+                        CACHE_ENTRIES.set(len(_decisions))
+                if result in (PASS, FAIL):
+                    return result, rule
+            else:
+                exec_policy_code(rule, rule.rule_code, globals_,
+                                 dict(locals_ or {}, action=action, rule=rule))
+        except Exception:
+            logger.exception('policy %s failed on action %s', rule.pk, action.pk)
+    return PENDING, None
+
+
+def notify(rule, action, result, globals_):
+    # notify hooks talk to the outside world, which the sandbox cannot
+    if sandbox.ENABLED:
+        return
+    _, hook = get_rule_functions(rule, globals_)
+    if hook is not None:
+        hook(action, result)
+
+
+def decision_cache_stats():
+    return _decisions.stats()
+
+
+def invalidate(policy_id):
+    with _lock:
+        _compiled.pop(policy_id, None)
+
+
+def rule_timings():
+    """
+    Timings for every policy executed by this process, slowest first.
+    """
+    with _lock:
+        timings = [t.as_dict() for t in _timings.values()]
+    return sorted(timings, key=lambda t: t['exec_time'], reverse=True)
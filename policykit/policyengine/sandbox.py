@@ -0,0 +1,229 @@
+"""
+Sandboxed execution of rule and process code.
+
+When POLICYENGINE_SANDBOX_RULES is on, policy code does not run inside the
+web request or the Celery task. It runs in a pool of warm worker processes
+(policyengine.sandbox_worker) that are started once and reused. Each
+execution gets a CPU time limit, the whole worker has a memory limit, and
+the caller gives up after a wall-clock limit and replaces the worker. A
+rule that loops or blows up therefore fails on its own, and every other
+rule keeps running.
+
+The worker only gets a serialized, read-only view of the policies in scope:
+their fields, votes, content object, author and community, with tokens left
+out (the policy whose code runs gets no author or votes). Anything the code asks for, like execute_action(action),
+policy.save() after a status change, or action.reevaluate_at(), comes back
+as an effect and is applied here on the real objects. Structured rules have
+their check() called in the worker and only the decision comes back.
+"""
+from django.conf import settings
+from datetime import datetime
+import json
+import logging
+import os
+import queue
+import select
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+ENABLED = getattr(settings, 'POLICYENGINE_SANDBOX_RULES', False)
+WORKERS = getattr(settings, 'POLICYENGINE_SANDBOX_WORKERS', 4)
+CPU_SECONDS = getattr(settings, 'POLICYENGINE_SANDBOX_CPU_SECONDS', 1.0)
+WALL_SECONDS = getattr(settings, 'POLICYENGINE_SANDBOX_WALL_SECONDS', 2.0)
+MEMORY_MB = getattr(settings, 'POLICYENGINE_SANDBOX_MEMORY_MB', 256)
+
+# fields that are never handed to rule code
+PRIVATE_FIELDS = ['access_token', 'password', 'rule_code', 'process_code']
+
+
+class SandboxError(Exception):
+    pass
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    raise TypeError('%r is not serializable' % value)
+
+
+def _decode(value):
+    if '__datetime__' in value:
+        return datetime.fromisoformat(value['__datetime__'])
+    return value
+
+
+def _fields(obj):
+    data = {}
+    if obj is None:
+        return data
+    for field in obj._meta.concrete_fields:
+        if field.name in PRIVATE_FIELDS:
+            continue
+        value = getattr(obj, field.attname)
+        if value is None or isinstance(value, (str, int, float, bool, datetime)):
+            data[field.attname] = value
+    data['pk'] = obj.pk
+    return data
+
+
+def serialize_policy(policy, related=True):
+    """
+    Fields of policy for the worker. With related=False, as for the policy
+    whose code runs, its author and votes are left out: nothing loads them
+    in advance, so they would cost queries on every call.
+    """
+    from policyengine.models import ActionPolicy
+
+    data = _fields(policy)
+    data['community_integration'] = _fields(policy.community_integration)
+    if related:
+        data['author'] = _fields(policy.author)
+        data['votes'] = [{'user_id': vote.user_id, 'value': vote.value} for vote in policy.uservote_set.all()]
+        if isinstance(policy, ActionPolicy):
+            data['content_object'] = _fields(policy.content_object)
+    return data
+
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sandbox_worker.py')
+
+
+class Worker(object):
+
+    def __init__(self):
+        # an empty directory, so the worker is nowhere near BASE_DIR with
+        # the database and private.py; -I keeps the script's directory and
+        # PYTHON* variables out of its path
+        self.directory = tempfile.mkdtemp(prefix='policykit-sandbox-')
+        self.process = subprocess.Popen(
+            [sys.executable, '-I', WORKER_SCRIPT,
+             str(CPU_SECONDS), str(MEMORY_MB * 1024 * 1024)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            cwd=self.directory,
+            # nothing from our environment (database credentials, secrets)
+            env={'PATH': os.environ.get('PATH', '')},
+            universal_newlines=True,
+        )
+
+    def call(self, request):
+        try:
+            self.process.stdin.write(json.dumps(request, default=_encode) + '\n')
+            self.process.stdin.flush()
+        except BrokenPipeError:
+            raise SandboxError('sandbox worker exited, probably out of memory')
+        ready, _, _ = select.select([self.process.stdout], [], [], WALL_SECONDS)
+        if not ready:
+            raise SandboxError('rule exceeded its wall clock limit')
+        line = self.process.stdout.readline()
+        if not line:
+            raise SandboxError('sandbox worker exited, probably out of memory')
+        return json.loads(line, object_hook=_decode)
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def kill(self):
+        self.process.kill()
+        self.process.wait()
+        for pipe in [self.process.stdin, self.process.stdout]:
+            try:
+                pipe.close()
+            except BrokenPipeError:
+                # a request was still buffered for the dead worker
+                pass
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class Pool(object):
+
+    def __init__(self, size):
+        self.idle = queue.Queue()
+        for _ in range(size):
+            self.idle.put(Worker())
+
+    def run(self, request):
+        worker = self.idle.get()
+        try:
+            return worker.call(request)
+        except Exception:
+            # the worker may be stuck mid-rule; start a fresh one
+            worker.kill()
+            worker = Worker()
+            raise
+        finally:
+            if not worker.alive():
+                worker.kill()
+                worker = Worker()
+            self.idle.put(worker)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().kill()
+            except queue.Empty:
+                return
+
+
+_lock = threading.Lock()
+_pool = None
+_pool_pid = None
+
+
+def get_pool():
+    global _pool, _pool_pid
+
+    if _pool is None or _pool_pid != os.getpid():
+        with _lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = Pool(WORKERS)
+                _pool_pid = os.getpid()
+    return _pool
+
+
+def run_policy_code(policy, digest, source, locals_, call=None):
+    """
+    Run source in the sandbox with serialized views of the policies in
+    locals_ and apply the effects it asks for to the real objects. With
+    call='check', the rule's check(action, votes) is called afterwards and
+    its result returned.
+    """
+    from policyengine.models import Policy
+    from policyengine.views import execute_action
+
+    # the same object may be in scope under several names (self and action)
+    objects = {}
+    names = {}
+    for name, value in locals_.items():
+        if isinstance(value, Policy):
+            key = str(id(value))
+            if key not in objects:
+                objects[key] = (value, serialize_policy(value, related=value is not policy))
+            names[name] = key
+
+    reply = get_pool().run({'key': '%s:%s' % (policy.pk, digest),
+                            'source': source,
+                            'objects': {key: data for key, (obj, data) in objects.items()},
+                            'names': names,
+                            'call': call,
+                            })
+    if not reply['ok']:
+        raise SandboxError(reply['error'])
+
+    for key, effects in reply['effects'].items():
+        obj = objects[key][0]
+        if hasattr(obj, 'evaluate_at'):
+            obj.evaluate_at = effects['evaluate_at']
+        if effects['reevaluate']:
+            obj.reevaluate_requested = True
+        if effects['execute']:
+            execute_action(obj)
+        elif effects['saved'] and effects['status'] != obj.status:
+            obj.status = effects['status']
+            obj.save()
+
+    return reply.get('result')
@@ -0,0 +1,205 @@
+"""
+Worker process for policyengine.sandbox.
+
+Runs as `python -I sandbox_worker.py CPU_SECONDS MEMORY_BYTES` from an empty
+directory. It does not import Django and never sees the database or the
+settings: each request on stdin is one JSON line with the code to run and a
+serialized view of the policies it may look at, and each reply on stdout is
+one JSON line with the effects the code asked for (execute the action,
+change a status, re-evaluate later) and, for structured rules, the result of
+check(). The parent applies those effects itself.
+
+Restricting builtins alone does not contain the code: from any object,
+attributes like __class__ or a generator's gi_frame lead back to the real
+builtins and modules. Code that touches an attribute starting with an
+underscore, or one of the frame and code attributes, is therefore rejected
+before it runs, and allowed imports only hand out a module's public names
+that are not modules themselves.
+"""
+import ast
+import builtins
+import datetime
+import json
+import resource
+import signal
+import sys
+import types
+
+ALLOWED_MODULES = ['collections', 'datetime', 'functools', 'itertools', 'json', 'math', 're', 'statistics']
+
+SAFE_BUILTINS = ['abs', 'all', 'any', 'bool', 'dict', 'divmod', 'enumerate', 'Exception', 'filter',
+                 'float', 'frozenset', 'int', 'isinstance', 'len', 'list', 'map',
+                 'max', 'min', 'next', 'print', 'range', 'reversed', 'round', 'set', 'sorted', 'str',
+                 'sum', 'tuple', 'zip', 'ValueError', 'KeyError', 'TypeError']
+
+# attributes without a leading underscore that still reach frames, and
+# through their globals everything else
+BLOCKED_ATTRIBUTES = ['gi_frame', 'gi_code', 'gi_yieldfrom', 'cr_frame', 'cr_code', 'cr_await',
+                      'ag_frame', 'ag_code', 'ag_await', 'f_back', 'f_builtins', 'f_code', 'f_globals',
+                      'f_locals', 'tb_frame', 'tb_next', 'func_globals', 'mro']
+
+
+class RuleTimeout(Exception):
+    pass
+
+
+class ModuleView(object):
+    """
+    The public names of an allowed module, without the modules it imported
+    itself (json.codecs.sys would lead to os).
+    """
+
+    def __init__(self, module):
+        for name, value in vars(module).items():
+            if not name.startswith('_') and not isinstance(value, types.ModuleType):
+                setattr(self, name, value)
+
+
+def _import(name, *args, **kwargs):
+    if name.split('.')[0] not in ALLOWED_MODULES:
+        raise ImportError('import of %s is not allowed in rules' % name)
+    return ModuleView(__import__(name, *args, **kwargs))
+
+
+def _decode(value):
+    if isinstance(value, dict) and '__datetime__' in value:
+        return datetime.datetime.fromisoformat(value['__datetime__'])
+    return value
+
+
+def _encode(value):
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    raise TypeError('%r is not serializable' % value)
+
+
+class View(object):
+    """
+    Read-only stand-in for a model instance: plain attributes, nested views
+    for related objects.
+    """
+
+    def __init__(self, data):
+        for name, value in data.items():
+            setattr(self, name, View(value) if isinstance(value, dict) else value)
+
+
+class VoteSet(object):
+
+    def __init__(self, votes):
+        self.votes = [View(vote) for vote in votes]
+
+    def all(self):
+        return list(self.votes)
+
+    def count(self):
+        return len(self.votes)
+
+
+class PolicyView(View):
+
+    def __init__(self, data):
+        votes = data.pop('votes', None)
+        super(PolicyView, self).__init__(data)
+        if votes is not None:
+            self.uservote_set = VoteSet(votes)
+            self.votes = self.uservote_set.all()
+        self._saved = False
+        self._execute = False
+        self._reevaluate = False
+
+    def save(self, *args, **kwargs):
+        self._saved = True
+
+    def reevaluate_at(self, when):
+        self._reevaluate = True
+        current = getattr(self, 'evaluate_at', None)
+        if current is None or when < current:
+            self.evaluate_at = when
+
+    def effects(self):
+        return {'execute': self._execute,
+                'saved': self._saved,
+                'status': getattr(self, 'status', None),
+                'evaluate_at': getattr(self, 'evaluate_at', None),
+                'reevaluate': self._reevaluate,
+                }
+
+
+def execute_action(action):
+    action._execute = True
+
+
+def _on_cpu_limit(signum, frame):
+    raise RuleTimeout('rule exceeded its CPU time limit')
+
+
+def compile_rule(source, filename):
+    tree = ast.parse(source, filename)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Attribute) and (node.attr.startswith('_') or node.attr in BLOCKED_ATTRIBUTES):
+            name = node.attr
+        elif isinstance(node, ast.Name) and node.id.startswith('__'):
+            name = node.id
+        else:
+            continue
+        raise SyntaxError('%s is not allowed in rules (line %s)' % (name, node.lineno))
+    return compile(tree, filename, 'exec')
+
+
+def run(request, compiled, cpu_seconds):
+    code = compiled.get(request['key'])
+    if code is None:
+        code = compiled[request['key']] = compile_rule(request['source'], '<policy %s>' % request['key'])
+
+    views = {key: PolicyView(data) for key, data in request['objects'].items()}
+    namespace = {'__builtins__': dict((name, getattr(builtins, name)) for name in SAFE_BUILTINS),
+                 'execute_action': execute_action,
+                 'datetime': datetime.datetime,
+                 'timedelta': datetime.timedelta,
+                 # same values as policyengine.rules
+                 'PASS': 'passed',
+                 'FAIL': 'failed',
+                 'PENDING': 'pending',
+                 }
+    namespace['__builtins__']['__import__'] = _import
+    for name, key in request['names'].items():
+        namespace[name] = views[key]
+
+    result = None
+    signal.setitimer(signal.ITIMER_PROF, cpu_seconds)
+    try:
+        exec(code, namespace)
+        if request.get('call') == 'check':
+            action = namespace['action']
+            result = namespace['check'](action, action.votes)
+    finally:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+
+    return {key: view.effects() for key, view in views.items()}, result
+
+
+def main():
+    cpu_seconds = float(sys.argv[1])
+    memory_bytes = int(sys.argv[2])
+    resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, memory_bytes))
+    signal.signal(signal.SIGPROF, _on_cpu_limit)
+
+    # print() in a rule must not end up in the replies
+    replies = sys.stdout
+    sys.stdout = sys.stderr
+
+    compiled = {}
+    for line in sys.stdin:
+        try:
+            request = json.loads(line, object_hook=_decode)
+            effects, result = run(request, compiled, cpu_seconds)
+            reply = {'ok': True, 'effects': effects, 'result': result}
+        except BaseException as e:
+            reply = {'ok': False, 'error': '%s: %s' % (type(e).__name__, e)}
+        replies.write(json.dumps(reply, default=_encode) + '\n')
+        replies.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -3,14 +3,145 @@ from __future__ import absolute_import, unicode_literals
 
 from celery import shared_task
 from celery.schedules import crontab
-from policyengine.models import UserVote, ActionPolicy, Policy, RulePolicy, CommunityUser
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+from datetime import timedelta
+from policyengine.models import UserVote, ActionPolicy, Policy, RulePolicy, CommunityUser, CommunityIntegration
 from policykit.celery import app
 from policyengine.views import *
+from policyengine import metrics, rules
+# connects the task hooks of the SQL profiler
+from policyengine import profiling
+import time
+import uuid
 
-@shared_task
-def consider_proposed_actions():
-    
+# deadlines closer than this are handed to Celery as ETA tasks; later ones
+# are scheduled by a safety sweep once they come within range, so keep this
+# a bit longer than the sweep interval
+SCHEDULE_HORIZON = timedelta(seconds=getattr(settings, 'POLICYENGINE_SCHEDULE_HORIZON_SECONDS', 360))
+
+# a triggered evaluation that finds its actions leased by another worker
+# tries again after 1, 2, 4... seconds, then leaves them to the safety sweep
+LEASED_RETRIES = 5
+
+
+SWEEP_SECONDS = metrics.histogram('policykit_sweep_seconds',
+                                  'Time to evaluate the pending actions of one community')
+ACTIONS_EVALUATED = metrics.counter('policykit_actions_evaluated_total',
+                                    'Actions run through the rules of their community')
+DECISIONS = metrics.counter('policykit_decisions_total',
+                            'Actions decided by structured rules',
+                            ['result'])
+
+
+def pending_actions(incremental):
     proposed_actions = ActionPolicy.objects.filter(status=Policy.PROPOSED)
-    for action in proposed_actions:
-        for rule in RulePolicy.objects.filter(status=Policy.PASSED, community_integration=action.community_integration):
-            exec(rule.rule_code)
+    if incremental:
+        # only actions whose votes or rules changed, or whose deadline is due
+        proposed_actions = proposed_actions.filter(Q(input_version__gt=F('evaluated_version')) |
+                                                   Q(evaluate_at__lte=timezone.now()))
+    return proposed_actions
+
+
+@metrics.gauge('policykit_backlog_actions', 'Proposed actions waiting to be evaluated')
+def backlog():
+    return pending_actions(True).count()
+
+
+def schedule_deadlines(deadlines):
+    # deadlines are (action id, evaluate_at); each due one gets an ETA task
+    now = timezone.now()
+    for action_id, evaluate_at in deadlines:
+        if evaluate_at and now < evaluate_at <= now + SCHEDULE_HORIZON:
+            consider_actions.apply_async([[action_id]], eta=evaluate_at)
+
+
+@shared_task
+def consider_proposed_actions(incremental=True):
+    # one subtask per community so the sweep spreads over the worker pool
+    community_ids = pending_actions(incremental).order_by().values_list('community_integration', flat=True).distinct()
+    for community_id in community_ids:
+        consider_community_actions.delay(community_id, incremental)
+
+    if incremental:
+        # deadlines set long ago are now close enough to schedule
+        now = timezone.now()
+        schedule_deadlines(ActionPolicy.objects.filter(status=Policy.PROPOSED,
+                                                       evaluate_at__gt=now,
+                                                       evaluate_at__lte=now + SCHEDULE_HORIZON)
+                                               .values_list('pk', 'evaluate_at'))
+
+
+@shared_task
+def consider_actions(action_ids, attempt=0):
+    # triggered by a vote or a deadline, so the decision does not wait for a sweep
+    community_ids = pending_actions(True).filter(pk__in=action_ids).order_by().values_list('community_integration', flat=True).distinct()
+    for community_id in community_ids:
+        consider_community_actions(community_id, True, action_ids, attempt)
+
+
+@shared_task
+def consider_community_actions(community_id, incremental=True, action_ids=None, attempt=0):
+    candidates = pending_actions(incremental).filter(community_integration=community_id)
+    if action_ids is not None:
+        candidates = candidates.filter(pk__in=action_ids)
+    candidates = list(candidates.values_list('pk', flat=True))
+    if not candidates:
+        return
+
+    # lease the actions so no other worker evaluates them at the same time
+    lease_owner = uuid.uuid4().hex
+    now = timezone.now()
+    ActionPolicy.objects.filter(pk__in=candidates).filter(
+        Q(lease_expires__isnull=True) | Q(lease_expires__lt=now)
+    ).update(lease_owner=lease_owner, lease_expires=now + ActionPolicy.LEASE)
+
+    actions = list(ActionPolicy.objects.filter(lease_owner=lease_owner)
+                                       .select_related('author')
+                                       .prefetch_related('content_object', 'uservote_set'))
+    if action_ids is not None and len(actions) < len(candidates) and attempt < LEASED_RETRIES:
+        # another worker is evaluating these and may not have seen the vote
+        # that triggered this; its result is written back as evaluated, so
+        # look again once its lease is likely gone
+        leased = list(set(candidates) - set(action.pk for action in actions))
+        consider_actions.apply_async([leased, attempt + 1], countdown=2 ** attempt)
+    if not actions:
+        return
+
+    start = time.perf_counter()
+    community = CommunityIntegration.objects.get(pk=community_id)
+    community_rules = list(RulePolicy.objects.filter(status=Policy.PASSED, community_integration=community_id))
+    for rule in community_rules:
+        rule.community_integration = community
+
+    evaluated = []
+    decisions = []
+    try:
+        # actions executed by plain rules are sent together at the end
+        with batch_execution():
+            for action in actions:
+                action.community_integration = community
+                action.evaluate_at = None
+                decision, rule = rules.evaluate_action(action, community_rules, globals())
+                if decision != rules.PENDING:
+                    decisions.append((action, decision, rule))
+                    DECISIONS.inc(result=decision)
+                evaluated.append(action)
+    finally:
+        # what was decided is applied even if a later action failed; if
+        # applying fails, the decided actions are evaluated again later
+        try:
+            ActionPolicy.apply_decisions(decisions)
+        except Exception:
+            decided = set(action.pk for action, decision, rule in decisions)
+            evaluated = [action for action in evaluated if action.pk not in decided]
+            raise
+        finally:
+            ActionPolicy.mark_all_evaluated(evaluated)
+            if len(evaluated) < len(actions):
+                done = set(action.pk for action in evaluated)
+                ActionPolicy.objects.filter(lease_owner=lease_owner).exclude(pk__in=done).update(lease_expires=None)
+            schedule_deadlines((action.pk, action.evaluate_at) for action in evaluated)
+            ACTIONS_EVALUATED.inc(len(evaluated))
+            SWEEP_SECONDS.observe(time.perf_counter() - start)
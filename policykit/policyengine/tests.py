@@ -1,3 +1,412 @@
-from django.test import TestCase
+from django.core.management import call_command
+from django.test import Client, TestCase
+from django.contrib.auth.models import Group
+from django.utils import timezone
+from policyengine import metrics, profiling, ratelimit, rules, sandbox
+from policyengine.models import ActionPolicy, Policy, RulePolicy, UserVote
+from policyengine.tasks import consider_actions, consider_community_actions, consider_proposed_actions, \
+    pending_actions
+from policykit.celery import app
+from slackintegration.models import SlackIntegration, SlackUser, SlackScheduleMessage
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+import json
+import os
+import shutil
+import tempfile
+import time
 
-# Create your tests here.
+VOTE_RULE = """
+yes = [v for v in action.uservote_set.all() if v.value]
+message = action.content_object.text
+author = action.author.readable_name
+community = action.community_integration.team_id
+"""
+
+CHECK_RULE = """
+def check(action, votes):
+    if len(votes) > 1:
+        return PASS
+    return PENDING
+"""
+
+PASS_RULE = """
+def check(action, votes):
+    return PASS
+"""
+
+def deadline_rule(hours):
+    return """
+def check(action, votes):
+    action.reevaluate_at(timezone.now() + timedelta(hours=%s))
+    return PENDING
+""" % hours
+
+RAISING_RULE = """
+if action.content_object.text == 'boom':
+    raise ValueError('boom')
+"""
+
+
+class ConsiderProposedActionsTest(TestCase):
+
+    def setUp(self):
+        # run the per-community subtasks inline
+        app.conf.task_always_eager = True
+        self.addCleanup(setattr, app.conf, 'task_always_eager', False)
+        rules._decisions.clear()
+
+        group = Group.objects.create(name='Slack')
+        self.communities = []
+        for i in range(2):
+            integration = SlackIntegration.objects.create(community_name='community%s' % i,
+                                                          team_id='T%s' % i,
+                                                          access_token='xoxb-%s' % i,
+                                                          user_group=group)
+            user = SlackUser.objects.create(username='U%s' % i,
+                                            password='password',
+                                            community_integration=integration,
+                                            user_id='U%s' % i,
+                                            readable_name='user%s' % i,
+                                            access_token='xoxp-%s' % i)
+            for _ in range(2):
+                self.add_rule(integration, user, VOTE_RULE)
+            self.communities.append((integration, user))
+
+    def add_rule(self, integration, user, code):
+        rule = RulePolicy.objects.create(community_integration=integration,
+                                         author=user,
+                                         rule_code=code,
+                                         explanation='rule')
+        rule.status = Policy.PASSED
+        rule.save()
+
+    def add_actions(self, count):
+        for integration, user in self.communities:
+            for _ in range(count):
+                message = SlackScheduleMessage.objects.create(community_integration=integration,
+                                                              author=user,
+                                                              text='hello',
+                                                              channel='C1',
+                                                              post_at=0)
+                policy = ActionPolicy.objects.get(object_id=message.pk)
+                UserVote.objects.create(user=user, policy=policy, value=True)
+
+    def test_query_count_is_independent_of_action_count(self):
+        for count in [1, 10]:
+            self.add_actions(count)
+            # one query to find the communities and one for upcoming
+            # deadlines, then per community: the candidates, the lease,
+            # actions, content objects, votes, the community (base and child
+            # table), rules and the watermark update
+            with self.assertNumQueries(2 + 9 * len(self.communities)):
+                consider_proposed_actions()
+
+    def test_query_count_is_independent_of_action_count_in_the_sandbox(self):
+        pool = sandbox.Pool(1)
+        self.addCleanup(pool.close)
+        with mock.patch.object(sandbox, 'ENABLED', True), mock.patch.object(sandbox, 'get_pool', return_value=pool):
+            self.test_query_count_is_independent_of_action_count()
+
+    def test_sweep_evaluates_only_changed_actions(self):
+        self.add_actions(3)
+        consider_proposed_actions()
+        with self.assertNumQueries(2):
+            consider_proposed_actions()
+
+    def test_full_sweep_reuses_decisions_for_unchanged_votes(self):
+        for integration, user in self.communities:
+            self.add_rule(integration, user, CHECK_RULE)
+        self.add_actions(2)
+        consider_proposed_actions()
+
+        before = rules.decision_cache_stats()
+        consider_proposed_actions(incremental=False)
+        after = rules.decision_cache_stats()
+        self.assertEqual(after['hits'] - before['hits'], 2 * len(self.communities))
+        self.assertEqual(after['misses'], before['misses'])
+        self.assertIn('policykit_decision_cache_lookups_total{result="hit"}', metrics.render())
+
+    def test_time_dependent_checks_are_not_cached(self):
+        for integration, user in self.communities:
+            self.add_rule(integration, user, deadline_rule(1))
+            # asks for a later deadline, which leaves evaluate_at unchanged
+            self.add_rule(integration, user, deadline_rule(2))
+        self.add_actions(1)
+        consider_proposed_actions()
+
+        before = rules.decision_cache_stats()
+        consider_proposed_actions(incremental=False)
+        self.assertEqual(rules.decision_cache_stats()['hits'], before['hits'])
+
+    def leased_actions(self):
+        self.add_actions(2)
+        integration = self.communities[0][0]
+        consider_proposed_actions()
+        actions = list(ActionPolicy.objects.filter(community_integration=integration).order_by('pk'))
+        ActionPolicy.mark_changed(community_integration=integration)
+        return integration, actions
+
+    def test_actions_leased_by_another_worker_are_skipped(self):
+        integration, (first, second) = self.leased_actions()
+        ActionPolicy.objects.filter(pk=first.pk).update(lease_owner='other',
+                                                        lease_expires=timezone.now() + ActionPolicy.LEASE)
+        # an expired lease is taken over
+        ActionPolicy.objects.filter(pk=second.pk).update(lease_owner='other',
+                                                         lease_expires=timezone.now() - timedelta(seconds=1))
+        consider_community_actions(integration.pk)
+
+        first, second = ActionPolicy.objects.filter(pk__in=[first.pk, second.pk]).order_by('pk')
+        self.assertEqual(first.lease_owner, 'other')
+        self.assertLess(first.evaluated_version, first.input_version)
+        self.assertNotEqual(second.lease_owner, 'other')
+        self.assertIsNone(second.lease_expires)
+        self.assertEqual(second.evaluated_version, second.input_version)
+
+    def test_leases_of_unevaluated_actions_are_released(self):
+        integration, (first, second) = self.leased_actions()
+        evaluate_action = rules.evaluate_action
+
+        def fail_on_second(action, *args):
+            if action.pk == second.pk:
+                raise RuntimeError('worker lost its database connection')
+            return evaluate_action(action, *args)
+
+        with mock.patch.object(rules, 'evaluate_action', fail_on_second), self.assertRaises(RuntimeError):
+            consider_community_actions(integration.pk)
+
+        first, second = ActionPolicy.objects.filter(pk__in=[first.pk, second.pk]).order_by('pk')
+        self.assertEqual(first.evaluated_version, first.input_version)
+        self.assertLess(second.evaluated_version, second.input_version)
+        self.assertIsNone(second.lease_expires)
+
+    def test_vote_on_leased_action_is_retried(self):
+        self.add_actions(1)
+        consider_proposed_actions()
+        action = ActionPolicy.objects.filter(community_integration=self.communities[0][0]).get()
+        # another worker is evaluating the action when a vote comes in
+        ActionPolicy.objects.filter(pk=action.pk).update(lease_owner='other',
+                                                         lease_expires=timezone.now() + ActionPolicy.LEASE)
+        ActionPolicy.mark_changed(pk=action.pk)
+
+        with mock.patch.object(consider_actions, 'apply_async') as apply_async:
+            consider_actions([action.pk])
+        apply_async.assert_called_once_with([[action.pk], 1], countdown=1)
+
+    def test_failing_rule_does_not_stop_other_decisions(self):
+        self.add_actions(1)
+        integration, user = self.communities[0]
+        boom = SlackScheduleMessage.objects.create(community_integration=integration,
+                                                   author=user,
+                                                   text='boom',
+                                                   channel='C1',
+                                                   post_at=0)
+        self.add_rule(integration, user, RAISING_RULE)
+        self.add_rule(integration, user, PASS_RULE)
+
+        with mock.patch('policyengine.models.execute_actions') as execute_actions:
+            consider_proposed_actions()
+        executed = [action.object_id for call in execute_actions.call_args_list for action in call[0][0]]
+        self.assertEqual(sorted(executed), sorted(SlackScheduleMessage.objects.filter(
+            community_integration=integration).values_list('pk', flat=True)))
+        self.assertIn(boom.pk, executed)
+
+    def test_save_keeps_concurrent_vote_watermark(self):
+        self.add_actions(1)
+        consider_proposed_actions()
+        action = ActionPolicy.objects.filter(community_integration=self.communities[0][0]).get()
+        # a vote comes in while rule code holds an older copy of the action
+        ActionPolicy.mark_changed(pk=action.pk)
+        action.status = Policy.FAILED
+        action.save()
+
+        stored = ActionPolicy.objects.get(pk=action.pk)
+        self.assertEqual(stored.status, Policy.FAILED)
+        self.assertEqual(stored.input_version, action.input_version + 1)
+
+    def test_repaired_tallies_are_evaluated_again(self):
+        self.add_actions(1)
+        consider_proposed_actions()
+        action = ActionPolicy.objects.filter(community_integration=self.communities[0][0]).get()
+        Policy.objects.filter(pk=action.pk).update(yes_votes=5)
+
+        call_command('repair_vote_tallies', stdout=StringIO())
+        self.assertEqual(list(pending_actions(True)), [action])
+
+    def test_moving_a_vote_updates_both_tallies(self):
+        self.add_actions(1)
+        integration, user = self.communities[0]
+        old, new = [ActionPolicy.objects.get(object_id=message.pk)
+                    for message in [SlackScheduleMessage.objects.filter(community_integration=integration).get(),
+                                    SlackScheduleMessage.objects.create(community_integration=integration,
+                                                                        author=user,
+                                                                        text='hello',
+                                                                        channel='C1',
+                                                                        post_at=0)]]
+        vote = UserVote.objects.get(policy=old)
+        vote.policy = new
+        vote.save()
+
+        old_after, new_after = Policy.objects.get(pk=old.pk), Policy.objects.get(pk=new.pk)
+        self.assertEqual((old_after.yes_votes, new_after.yes_votes), (0, 1))
+        self.assertGreater(old_after.tally_version, old.tally_version)
+        self.assertGreater(new_after.tally_version, new.tally_version)
+
+
+class MetricsTest(TestCase):
+
+    def test_rate_limit_waits_are_exported(self):
+        bucket = ratelimit.TokenBucket(60, 'post')
+        bucket.tokens = 0.95
+        bucket.acquire()
+
+        rendered = metrics.render()
+        self.assertIn('# TYPE policykit_slack_rate_limit_waiting gauge', rendered)
+        self.assertIn('policykit_slack_rate_limit_waiting{tier="post"} 0', rendered)
+        self.assertIn('policykit_slack_rate_limit_wait_seconds_count{tier="post"}', rendered)
+
+    def test_gauges_of_exited_processes_are_ignored(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        waiting = ratelimit.QUEUE_DEPTH.name
+        pauses = ratelimit.RATE_LIMITED.name
+        for name, age in [('metrics-live.json', 0), ('metrics-exited.json', 3600)]:
+            path = os.path.join(directory, name)
+            with open(path, 'w') as f:
+                json.dump({waiting: [[['tier1'], 1]], pauses: [[['tier1'], 1]]}, f)
+            os.utime(path, (time.time() - age, time.time() - age))
+
+        with mock.patch.object(metrics, 'METRICS_DIR', directory):
+            totals = metrics.collect()
+        self.assertEqual(totals[waiting][('tier1',)], 1)
+        self.assertEqual(totals[pauses][('tier1',)], 2)
+
+    def test_snapshots_of_exited_processes_are_retired(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        waiting = ratelimit.QUEUE_DEPTH.name
+        pauses = ratelimit.RATE_LIMITED.name
+        # our pid, but an earlier start time: a process whose pid was reused
+        exited = os.path.join(directory, 'metrics-%s-0.json' % os.getpid())
+        with open(exited, 'w') as f:
+            json.dump({waiting: [[['tier1'], 1]], pauses: [[['tier1'], 2]]}, f)
+        with open(os.path.join(directory, metrics.RETIRED), 'w') as f:
+            json.dump({pauses: [[['tier1'], 3]]}, f)
+
+        with mock.patch.object(metrics, 'METRICS_DIR', directory):
+            first = metrics.collect()
+            second = metrics.collect()
+        self.assertFalse(os.path.exists(exited))
+        self.assertEqual(first[pauses][('tier1',)], 5)
+        self.assertEqual(second[pauses][('tier1',)], 5)
+        self.assertNotIn(('tier1',), second.get(waiting, {}))
+
+
+class SandboxTest(TestCase):
+
+    def setUp(self):
+        self.pool = sandbox.Pool(1)
+        self.addCleanup(self.pool.close)
+        patcher = mock.patch.object(sandbox, 'get_pool', return_value=self.pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        group = Group.objects.create(name='Slack')
+        integration = SlackIntegration.objects.create(community_name='community',
+                                                      team_id='T0',
+                                                      access_token='xoxb-0',
+                                                      user_group=group)
+        self.user = SlackUser.objects.create(username='U0',
+                                             password='password',
+                                             community_integration=integration,
+                                             user_id='U0',
+                                             readable_name='user',
+                                             access_token='xoxp-0')
+        self.rule = RulePolicy.objects.create(community_integration=integration,
+                                              author=self.user,
+                                              explanation='rule')
+        message = SlackScheduleMessage.objects.create(community_integration=integration,
+                                                      author=self.user,
+                                                      text='hello',
+                                                      channel='C1',
+                                                      post_at=0)
+        self.action = ActionPolicy.objects.get(object_id=message.pk)
+
+    def run_rule(self, code, call=None):
+        return sandbox.run_policy_code(self.rule, rules._digest(code), code, {'action': self.action}, call)
+
+    def worker(self):
+        return self.pool.idle.queue[0]
+
+    def test_effects_are_applied_to_the_real_action(self):
+        with mock.patch('policyengine.views.execute_action') as execute_action:
+            self.run_rule('if action.content_object.text == "hello":\n    execute_action(action)')
+        execute_action.assert_called_once_with(self.action)
+
+        self.run_rule('action.status = "failed"\naction.save()')
+        self.assertEqual(ActionPolicy.objects.get(pk=self.action.pk).status, Policy.FAILED)
+
+    def test_check_result_comes_back(self):
+        UserVote.objects.create(user=self.user, policy=self.action, value=True)
+        code = 'def check(action, votes):\n    return PASS if votes[0].value else PENDING'
+        self.assertEqual(self.run_rule(code, call='check'), rules.PASS)
+
+    def test_cpu_and_memory_limits(self):
+        with self.assertRaisesRegex(sandbox.SandboxError, 'CPU time limit'):
+            self.run_rule('while True:\n    pass')
+        with self.assertRaisesRegex(sandbox.SandboxError, 'MemoryError'):
+            self.run_rule('x = "x" * 10 ** 9')
+        self.assertIsNone(self.run_rule('x = 1'))
+
+    def test_stuck_or_dead_worker_is_replaced(self):
+        stuck = self.worker()
+        with mock.patch.object(sandbox, 'WALL_SECONDS', 0.2), \
+                self.assertRaisesRegex(sandbox.SandboxError, 'wall clock'):
+            self.run_rule('while True:\n    pass')
+        self.assertFalse(stuck.alive())
+
+        dead = self.worker()
+        self.assertIsNot(dead, stuck)
+        dead.process.kill()
+        with self.assertRaisesRegex(sandbox.SandboxError, 'exited'):
+            self.run_rule('x = 1')
+        self.assertIsNot(self.worker(), dead)
+        self.assertIsNone(self.run_rule('x = 1'))
+
+    def test_rules_cannot_reach_outside_the_worker(self):
+        self.assertEqual(os.listdir(self.worker().directory), [])
+        for code in ['().__class__.__base__.__subclasses__()',
+                     'def g():\n    yield gen.gi_frame\ngen = g()',
+                     'getattr(action, "status")',
+                     'import os',
+                     'import json\njson.codecs']:
+            with self.assertRaises(sandbox.SandboxError):
+                self.run_rule(code)
+
+
+class SQLProfilerTest(TestCase):
+
+    def test_fingerprint_folds_literals(self):
+        self.assertEqual(profiling.fingerprint("SELECT a FROM t WHERE id IN (%s, %s, %s) AND b = 'x''y' AND c = 12"),
+                         "SELECT a FROM t WHERE id IN (...) AND b = ? AND c = ?")
+
+    def test_request_profile_header(self):
+        with mock.patch.object(profiling, 'ENABLED', True), mock.patch.object(profiling, 'HEADER', True):
+            response = Client().get('/policyengine/metrics')
+        self.assertRegex(response['X-SQL-Profile'], r'^[1-9]\d* queries, [\d.]+ms SQL$')
+
+    def test_repeated_queries_are_reported(self):
+        profile = profiling.QueryProfile('n+1')
+        profile.install()
+        try:
+            for pk in range(5):
+                list(Group.objects.filter(pk=pk))
+        finally:
+            profile.uninstall()
+
+        with mock.patch.object(profiling, 'MAX_REPEATS', 3), \
+                self.assertLogs('policyengine.profiling', 'WARNING') as logs:
+            profile.report()
+        self.assertIn('n+1: 5 queries', logs.output[0])
+        self.assertIn('5x SELECT', logs.output[0])
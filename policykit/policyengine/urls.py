@@ -3,5 +3,5 @@ from policyengine import views
 
 
 urlpatterns = [
-    
+    path('metrics', views.metrics_view),
 ]
\ No newline at end of file
@@ -1,32 +1,46 @@
 from django.shortcuts import render
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.http import HttpResponseRedirect, HttpResponse
+from policyengine import api_client, metrics
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import urllib.request
 import urllib.parse
 import logging
 import json
+import threading
 
 logger = logging.getLogger(__name__)
 
+# concurrent Slack calls when executing a batch of actions; the rate limiter
+# in api_client still applies to each of them
+EXECUTE_THREADS = getattr(settings, 'POLICYENGINE_EXECUTE_THREADS', 10)
 
-def execute_action(action):
-    logger.info('here')
-    logger.info('EXECUTING ACTION BELOW:')
-    logger.info(action)
-    
+EXCLUDED_FIELDS = ['polymorphic_ctype', 'community_integration', 'author', 'communityaction_ptr', 'action_policy', 'id']
+
+# model class -> names of the fields sent to Slack
+_field_names = {}
+
+_batch = threading.local()
+
+
+def _get_field_names(model):
+    names = _field_names.get(model)
+    if names is None:
+        names = _field_names[model] = [f.name for f in model._meta.get_fields()
+                                       if f.name not in EXCLUDED_FIELDS]
+    return names
+
+
+def _build_requests(action):
+    # everything that touches the database happens here, before the calls
+    # are handed to other threads
     community_integration = action.community_integration
     
     obj = action.content_object
     call = community_integration.API + obj.ACTION
     
-    logger.info(call)
-
-    
-    obj_fields = []
-    for f in obj._meta.get_fields():
-        if f.name not in ['polymorphic_ctype','community_integration','author','communityaction_ptr']:
-            obj_fields.append(f.name) 
-    
     data = {}
     
     if obj.AUTH == "user":
@@ -34,49 +48,91 @@ def execute_action(action):
     else:
         data['token'] = community_integration.access_token
     
-    logger.info('here2')
-    
-    for item in obj_fields:
+    for item in _get_field_names(type(obj)):
         try :
-            if item != 'id':
-                value = getattr(obj, item)
-                data[item] = value
+            data[item] = getattr(obj, item)
         except obj.DoesNotExist:
             continue
     
-    data = urllib.parse.urlencode(data).encode('ascii')
-    
-    logger.info(data)
-
-    response = urllib.request.urlopen(url=call, data=data)
-    
-    html = response.read()
-    
-    logger.info(html)
-    
-    res = json.loads(html)
-    
+    requests = [(call, data)]
     
     if obj.community_post_id:
         values = {'token': action.author.access_token,
                   'ts': obj.community_post_id,
                   'channel': obj.channel
                 }
-        data = urllib.parse.urlencode(values)
-        data = data.encode('utf-8')
-        call_info = community_integration.API + 'chat.delete?'
-        req = urllib.request.Request(call_info, data)
-        resp = urllib.request.urlopen(req)
-        res = json.loads(resp.read().decode('utf-8'))
-        logger.info(res)
-    
+        requests.append((community_integration.API + 'chat.delete', values))
     
+    return community_integration.pk, requests
+
+
+def _send(action, workspace, requests):
+    logger.info('executing action %s', action.pk)
+    try:
+        for call, values in requests:
+            res = api_client.api_call(call, values, workspace=workspace)
+    except Exception:
+        # one failing action must not stop the rest of the batch
+        logger.exception('action %s failed', action.pk)
+        return False
+    
+    if not res['ok']:
+        logger.info(res['error'])
+    return res['ok']
+
+
+def execute_actions(actions):
+    """
+    Send the Slack calls for actions concurrently and mark the ones that
+    went through as passed with one bulk update.
+    """
+    from policyengine.models import Policy
+    
+    actions = list({action.pk: action for action in actions}.values())
+    if not actions:
+        return
+    
+    prepared = [(action,) + _build_requests(action) for action in actions]
+    if len(prepared) == 1:
+        results = [_send(*prepared[0])]
+    else:
+        with ThreadPoolExecutor(max_workers=min(EXECUTE_THREADS, len(prepared))) as pool:
+            results = list(pool.map(lambda args: _send(*args), prepared))
     
-    if res['ok']:
-        from policyengine.models import Policy
+    passed = [action for action, ok in zip(actions, results) if ok]
+    for action in passed:
         action.status = Policy.PASSED
-        action.save()
+    Policy.objects.bulk_update(passed, ['status'])
+
+
+@contextmanager
+def batch_execution():
+    """
+    Collect the execute_action calls made inside the block, e.g. by rule
+    code during a sweep, and execute them together when it ends.
+    """
+    if getattr(_batch, 'actions', None) is not None:
+        # already inside a batch
+        yield
+        return
+    
+    _batch.actions = []
+    try:
+        yield
+    finally:
+        actions, _batch.actions = _batch.actions, None
+        execute_actions(actions)
+
+
+def execute_action(action):
+    if getattr(_batch, 'actions', None) is not None:
+        _batch.actions.append(action)
     else:
-        error_message = res['error']
-        logger.info(error_message)
+        execute_actions([action])
+
+
+def metrics_view(request):
+    # registers the gauges that are computed on scrape
+    import policyengine.tasks
     
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
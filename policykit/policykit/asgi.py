@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'policykit.settings')
 
 application = get_asgi_application()
+
+# imported once Django is set up by get_asgi_application()
+from slackintegration.asgi import route
+
+application = route(application)
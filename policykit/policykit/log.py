@@ -0,0 +1,131 @@
+"""
+Logging pieces used by LOGGING in settings.py.
+
+QueueFileHandler takes records off the calling thread: emit() only puts the
+record on an in-memory queue and a background listener writes it to the
+file, so a slow disk never holds up a webhook or a Celery task. When the
+queue is full, records are dropped and counted instead of blocking.
+
+Before a record is queued its message is redacted (Slack tokens) and capped
+at max_length, so a full event payload or API response cannot fill the
+log. SamplingFilter keeps only a share of the DEBUG/INFO records of chatty
+loggers, and JSONFormatter writes one JSON object per line.
+"""
+from policyengine import metrics
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import threading
+
+DROPPED = metrics.counter('policykit_log_records_dropped_total',
+                          'Log records dropped because the log queue was full')
+
+TOKEN = re.compile(r'xox[a-z]-[A-Za-z0-9-]+')
+
+
+class QueueFileHandler(logging.handlers.QueueHandler):
+
+    def __init__(self, filename, max_length=2000, queue_size=10000):
+        self.filename = filename
+        self.max_length = max_length
+        self.queue_size = queue_size
+        self.file_handler = logging.FileHandler(filename, delay=True)
+        self.listener = None
+        self.pid = None
+        self.start_lock = threading.Lock()
+        super(QueueFileHandler, self).__init__(queue.Queue(queue_size))
+
+    def setFormatter(self, fmt):
+        # formatting happens in the listener thread
+        self.file_handler.setFormatter(fmt)
+
+    def start(self):
+        # a forked Celery worker inherits the queue but not the listener
+        # thread, so every process starts its own
+        with self.start_lock:
+            if self.pid == os.getpid():
+                return
+            self.queue = queue.Queue(self.queue_size)
+            self.listener = logging.handlers.QueueListener(self.queue, self.file_handler)
+            self.listener.start()
+            self.pid = os.getpid()
+
+    def stop(self):
+        if self.listener is not None and self.pid == os.getpid():
+            self.listener.stop()
+            self.pid = None
+
+    def close(self):
+        self.stop()
+        self.file_handler.close()
+        super(QueueFileHandler, self).close()
+
+    def prepare(self, record):
+        message = TOKEN.sub('xox?-[redacted]', record.getMessage())
+        if len(message) > self.max_length:
+            message = '%s... [%s more characters]' % (message[:self.max_length], len(message) - self.max_length)
+        record = copy.copy(record)
+        record.msg = message
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED.inc()
+
+    def emit(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        super(QueueFileHandler, self).emit(record)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep only a share of the records below WARNING, per logger:
+    rates = {'slackintegration.views': 0.1} keeps one in ten from that
+    logger and its children. Loggers without a rate keep everything.
+    """
+
+    def __init__(self, rates=None):
+        super(SamplingFilter, self).__init__()
+        self.rates = rates or {}
+
+    def rate(self, name):
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition('.')[0]
+        return 1.0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        return random.random() < self.rate(record.name)
+
+
+# attributes every LogRecord has; anything else came in through extra=
+_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message'}
+
+
+class JSONFormatter(logging.Formatter):
+
+    def format(self, record):
+        data = {'time': self.formatTime(record),
+                'level': record.levelname,
+                'logger': record.name,
+                'process': record.process,
+                'message': record.getMessage(),
+                }
+        for name, value in vars(record).items():
+            if name not in _RECORD_FIELDS:
+                data[name] = value
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
@@ -59,6 +59,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # only active with POLICYENGINE_PROFILE_SQL
+    'policyengine.profiling.SQLProfilerMiddleware',
 ]
 
 ROOT_URLCONF = 'policykit.urls'
@@ -85,12 +87,42 @@ WSGI_APPLICATION = 'policykit.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.0/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+# The web process, the Celery workers and beat all write concurrently, so
+# production should run on PostgreSQL: set POLICYKIT_DB_ENGINE=postgresql and
+# the POLICYKIT_DB_* variables below. POLICYKIT_DB_HOST/PORT can point at a
+# pgbouncer instead of the server to pool connections across processes.
+# Tests run against the same server in the POLICYKIT_TEST_DB_NAME database.
+# SQLite stays the default for local development.
+
+DB_ENGINE = os.environ.get('POLICYKIT_DB_ENGINE', 'sqlite3')
+
+if DB_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POLICYKIT_DB_NAME', 'policykit'),
+            'USER': os.environ.get('POLICYKIT_DB_USER', 'policykit'),
+            'PASSWORD': os.environ.get('POLICYKIT_DB_PASSWORD', ''),
+            'HOST': os.environ.get('POLICYKIT_DB_HOST', 'localhost'),
+            'PORT': os.environ.get('POLICYKIT_DB_PORT', '5432'),
+            # keep connections open between requests and tasks
+            'CONN_MAX_AGE': int(os.environ.get('POLICYKIT_DB_CONN_MAX_AGE', 60)),
+            'TEST': {
+                'NAME': os.environ.get('POLICYKIT_TEST_DB_NAME', 'test_policykit'),
+            },
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+            'OPTIONS': {
+                # wait for the write lock instead of failing right away
+                'timeout': 20,
+            },
+        }
     }
-}
 
 
 # Password validation
@@ -138,15 +170,103 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static/')
 
 PROJECT_NAME = "PolicyKit"
 
+# how long a Slack event_id is remembered in the cache to drop redeliveries;
+# the unique constraint on SlackEvent.event_id covers anything older
+SLACK_EVENT_DEDUP_SECONDS = 3600
+
+# a worker that has not finished an event after this long is taken to have
+# died and the event is handed out again; events that keep failing before
+# they call Slack are retried by requeue_unprocessed_events up to
+# SLACK_EVENT_MAX_ATTEMPTS times, events that fail after are not retried
+SLACK_EVENT_CLAIM_SECONDS = 300
+SLACK_EVENT_MAX_ATTEMPTS = 5
+
+# threads the ASGI Slack webhook (slackintegration.asgi) uses to store
+# events; each one holds a database connection
+SLACK_ASYNC_THREADS = 20
+
+# the default cache lives in each process; 'shared' is seen by every process
+# and holds state the slack workers must agree on (channel names). It needs
+# `python3 manage.py createcachetable`, or point it at memcached instead
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'policykit_cache',
+    },
+}
+
+# how long channel names from conversations.info are trusted; channel_rename
+# events and our own reverts keep cached entries current in the meantime
+SLACK_CHANNEL_CACHE = 'shared'
+SLACK_CHANNEL_CACHE_SECONDS = 3600
+
+# in-process cache of team_id -> integration and user_id -> SlackUser used by
+# every incoming event; saves in other processes are picked up after this long
+SLACK_LOOKUP_CACHE_SIZE = 1000
+SLACK_LOOKUP_CACHE_SECONDS = 60
+
+# run rule and process code in a pool of limited worker processes instead of
+# in the web request / Celery task; rules then only see a read-only view of
+# the policies and cannot query the database themselves
+POLICYENGINE_SANDBOX_RULES = False
+POLICYENGINE_SANDBOX_WORKERS = 4
+POLICYENGINE_SANDBOX_CPU_SECONDS = 1.0
+POLICYENGINE_SANDBOX_WALL_SECONDS = 2.0
+POLICYENGINE_SANDBOX_MEMORY_MB = 256
+
+# number of (rule, action, vote tally) decisions of structured rules that
+# each process remembers, so unchanged actions are not checked again
+POLICYENGINE_DECISION_CACHE_SIZE = 10000
+
+# deadlines up to this far ahead are queued as Celery ETA tasks; should be a
+# little longer than the safety sweep interval in CELERY_BEAT_SCHEDULE
+POLICYENGINE_SCHEDULE_HORIZON_SECONDS = 360
+
+# served at /policyengine/metrics; the web process and every Celery worker
+# write their metrics here so the endpoint can add them up
+POLICYENGINE_METRICS_DIR = os.environ.get('POLICYKIT_METRICS_DIR')
+POLICYENGINE_METRICS_FLUSH_SECONDS = 10
+
+# log requests and Celery tasks that run too many queries, spend too long in
+# SQL or repeat the same query (N+1), see policyengine.profiling
+POLICYENGINE_PROFILE_SQL = os.environ.get('POLICYKIT_PROFILE_SQL') == '1'
+POLICYENGINE_PROFILE_MAX_QUERIES = 50
+POLICYENGINE_PROFILE_MAX_SQL_SECONDS = 0.5
+POLICYENGINE_PROFILE_MAX_REPEATS = 10
+POLICYENGINE_PROFILE_HEADER = False
+
+
+# records are written by a background thread (policykit.log.QueueFileHandler)
+# as one JSON object per line, with Slack tokens redacted and messages capped;
+# LOG_SAMPLE_RATES keeps only a share of the DEBUG/INFO records of a logger
+LOG_LEVEL = os.environ.get('POLICYKIT_LOG_LEVEL', 'INFO')
+LOG_SAMPLE_RATES = {}
 
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
+    'formatters': {
+        'json': {
+            '()': 'policykit.log.JSONFormatter',
+        },
+    },
+    'filters': {
+        'sampling': {
+            '()': 'policykit.log.SamplingFilter',
+            'rates': LOG_SAMPLE_RATES,
+        },
+    },
     'handlers': {
         'file': {
             'level': 'DEBUG',
-            'class': 'logging.FileHandler',
+            'class': 'policykit.log.QueueFileHandler',
             'filename': '/var/log/django/debug.log',
+            'max_length': 2000,
+            'formatter': 'json',
+            'filters': ['sampling'],
         },
     },
     'loggers': {
@@ -157,12 +277,12 @@ LOGGING = {
         },
         'slackintegration': {
             'handlers': ['file'],
-            'level': 'DEBUG',
+            'level': LOG_LEVEL,
             'propagate': True,
         },
         'policyengine': {
             'handlers': ['file'],
-            'level': 'DEBUG',
+            'level': LOG_LEVEL,
             'propagate': True,
         },
     },
@@ -175,11 +295,30 @@ CELERY_BROKER_URL = 'amqp://'
 CELERY_RESULT_BACKEND = 'django-db'
 CELERY_CACHE_BACKEND = 'django-cache'
 
+# Slack event processing runs on its own queue so its concurrency can be
+# limited separately, e.g. celery -A policykit worker -Q slack --concurrency 4
+CELERY_TASK_ROUTES = {
+    'slackintegration.tasks.*': {'queue': 'slack'},
+}
+
 
+# actions are evaluated when a vote or rule changes and at the deadlines
+# rules ask for; this sweep only catches up on anything those triggers
+# missed (lost tasks, worker restarts) and schedules upcoming deadlines
 CELERY_BEAT_SCHEDULE = {
- 'count-votes-beat': {
+ 'safety-sweep-beat': {
+       'task': 'policyengine.tasks.consider_proposed_actions',
+       'schedule': 300.0,
+    },
+ # safety net for rules that depend on time without calling reevaluate_at
+ 'full-sweep-beat': {
        'task': 'policyengine.tasks.consider_proposed_actions',
-       'schedule': 60.0,
-    }       
+       'schedule': 1800.0,
+       'kwargs': {'incremental': False},
+    },
+ 'requeue-slack-events-beat': {
+       'task': 'slackintegration.tasks.requeue_unprocessed_events',
+       'schedule': 300.0,
+    }
 }
 
@@ -0,0 +1,94 @@
+"""
+Asynchronous handling of Slack's event webhook.
+
+Django 3.0 has no async views: under ASGI every view still takes one of a
+handful of threads for its whole duration, including the time spent reading
+the request and waiting on the database. route() puts a small ASGI app in
+front of Django that answers POST /slack/action on the event loop instead.
+Parsing and validation happen in the loop. Only the short blocking part
+(dedup, insert, queueing the Celery task) goes to a thread pool, so one
+process can hold hundreds of concurrent deliveries.
+"""
+from django.conf import settings
+from django.db import close_old_connections
+from django.http import HttpResponse, HttpResponseServerError
+from slackintegration.views import ACK_SECONDS, parse_action, store_event
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+ACTION_PATH = '/slack/action'
+
+THREADS = getattr(settings, 'SLACK_ASYNC_THREADS', 20)
+
+_executor = ThreadPoolExecutor(max_workers=THREADS, thread_name_prefix='slack-events')
+
+
+def _store_event(json_data, body, retry_num):
+    # what request_started/request_finished do for a normal Django request
+    close_old_connections()
+    try:
+        store_event(json_data, body, retry_num)
+    finally:
+        close_old_connections()
+
+
+async def _read_body(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+
+async def _send_response(send, response):
+    headers = [(name.encode('latin1'), value.encode('latin1')) for name, value in response.items()]
+    await send({'type': 'http.response.start',
+                'status': response.status_code,
+                'headers': headers,
+                })
+    await send({'type': 'http.response.body', 'body': response.content})
+
+
+async def action(scope, receive, send):
+    start = time.perf_counter()
+    body = await _read_body(receive)
+    if body is None:
+        return
+
+    response, json_data = parse_action(body)
+    if response is None:
+        retry_num = dict(scope['headers']).get(b'x-slack-retry-num')
+        if retry_num is not None:
+            retry_num = retry_num.decode('latin1')
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(_executor, _store_event, json_data, body, retry_num)
+            response = HttpResponse("")
+            ACK_SECONDS.observe(time.perf_counter() - start, event_type=json_data['event'].get('type'))
+        except Exception:
+            # Slack retries on a 500, so the event is not lost
+            logger.exception('could not store event %s', json_data.get('event_id'))
+            response = HttpResponseServerError()
+    await _send_response(send, response)
+
+
+def route(django_application):
+    """
+    Wrap the Django ASGI application so the Slack event webhook is served
+    by action() and everything else by Django.
+    """
+    async def application(scope, receive, send):
+        if scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] == ACTION_PATH:
+            await action(scope, receive, send)
+        else:
+            await django_application(scope, receive, send)
+
+    return application
@@ -2,9 +2,7 @@ from django.conf import settings
 from django.contrib.auth.backends import BaseBackend
 from django.contrib.auth.models import User
 from slackintegration.models import SlackUser, SlackIntegration
-from urllib import parse
-import urllib.request
-import json
+from policyengine import api_client
 import logging
 
 logger = logging.getLogger(__name__)
@@ -18,9 +16,9 @@ class SlackBackend(BaseBackend):
         s = SlackIntegration.objects.filter(team_id=oauth['team']['id'])
 
         if s.exists():
-            user_data = parse.urlencode({
+            user_data = {
                     'token': oauth['authed_user']['access_token']
-                    }).encode()
+                    }
 
             slack_user = SlackUser.objects.filter(user_id=oauth['authed_user']['id'])
             if slack_user.exists():
@@ -34,9 +32,7 @@ class SlackBackend(BaseBackend):
                 slack_user.password = oauth['authed_user']['access_token']
                 slack_user.save()
             else:
-                user_req = urllib.request.Request('https://slack.com/api/users.identity?', data=user_data)
-                user_resp = urllib.request.urlopen(user_req)
-                user_res = json.loads(user_resp.read().decode('utf-8'))
+                user_res = api_client.api_call(SlackIntegration.API + 'users.identity', user_data)
 
                 slack_user = SlackUser.objects.create(
                     username=oauth['authed_user']['id'],
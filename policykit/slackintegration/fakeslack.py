@@ -0,0 +1,91 @@
+"""
+Local stand-in for the Slack Web API, used by the benchmarks.
+
+FakeSlack serves every method on a local port with a response that is good
+enough for the code paths PolicyKit exercises (a ts for posted messages, a
+channel for conversations.info). It can add latency to every call and
+answer a fraction of them with 429 and a Retry-After header. While it runs,
+SlackIntegration.API points at it, so nothing reaches the real Slack.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from slackintegration.models import SlackIntegration
+from collections import Counter
+import itertools
+import json
+import random
+import threading
+import time
+
+
+class FakeSlackHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        slack = self.server.slack
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        method = self.path.rsplit('/', 1)[-1]
+
+        if slack.latency:
+            time.sleep(slack.latency)
+
+        with slack.lock:
+            limited = slack.random.random() < slack.rate_limit
+            slack.calls[method] += 1
+            if limited:
+                slack.rate_limited[method] += 1
+            ts = '%d.%06d' % (1500000000, next(slack.ts))
+
+        if limited:
+            self.send_response(429)
+            self.send_header('Retry-After', str(slack.retry_after))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = json.dumps({'ok': True,
+                           'ts': ts,
+                           'channel': {'id': 'C0', 'name': 'general', 'previous_names': ['old-general']},
+                           }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeSlack(object):
+    """
+    Use as a context manager:
+
+        with FakeSlack(latency=0.05, rate_limit=0.01) as slack:
+            ...
+        slack.calls  # Counter of calls per method
+    """
+
+    def __init__(self, latency=0.0, rate_limit=0.0, retry_after=0.05, seed=0):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.rate_limited = Counter()
+        self.ts = itertools.count(1)
+        self.server = None
+
+    def __enter__(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeSlackHandler)
+        self.server.daemon_threads = True
+        self.server.slack = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.real_api = SlackIntegration.API
+        SlackIntegration.API = 'http://127.0.0.1:%s/api/' % self.server.server_port
+        return self
+
+    def __exit__(self, *exc_info):
+        SlackIntegration.API = self.real_api
+        self.server.shutdown()
+        self.server.server_close()
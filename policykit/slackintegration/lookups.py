@@ -0,0 +1,45 @@
+"""
+Cached lookups used by every incoming Slack event: the integration for a
+team_id, the SlackUser for a Slack user_id and the default action author.
+Entries are dropped when the models are saved or deleted in this process
+and expire after SLACK_LOOKUP_CACHE_SECONDS to pick up changes made by
+other processes.
+"""
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from policyengine.cache import LRUCache
+from slackintegration.models import SlackIntegration, SlackUser
+
+CACHE_SIZE = getattr(settings, 'SLACK_LOOKUP_CACHE_SIZE', 1000)
+CACHE_SECONDS = getattr(settings, 'SLACK_LOOKUP_CACHE_SECONDS', 60)
+
+integrations = LRUCache(CACHE_SIZE, CACHE_SECONDS)
+users = LRUCache(CACHE_SIZE, CACHE_SECONDS)
+authors = LRUCache(1, CACHE_SECONDS)
+
+
+def get_integration(team_id):
+    return integrations.get_or_load(team_id, lambda: SlackIntegration.objects.get(team_id=team_id))
+
+
+def get_user(user_id):
+    return users.get_or_load(user_id, lambda: SlackUser.objects.get(user_id=user_id))
+
+
+def get_default_author():
+    return authors.get_or_load('default', lambda: SlackUser.objects.all()[0]) # TODO Change this to admin user? Bot user?
+
+
+@receiver(post_save, sender=SlackIntegration)
+@receiver(post_delete, sender=SlackIntegration)
+def integration_changed(sender, instance, **kwargs):
+    # team_id itself may have changed, so forget every entry
+    integrations.clear()
+
+
+@receiver(post_save, sender=SlackUser)
+@receiver(post_delete, sender=SlackUser)
+def user_changed(sender, instance, **kwargs):
+    users.delete(instance.user_id)
+    authors.clear()
@@ -0,0 +1,208 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import Group
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, setup_databases, teardown_databases, \
+    setup_test_environment, teardown_test_environment
+from policyengine import ratelimit
+from policyengine.models import Policy, RulePolicy
+from policykit.celery import app
+from slackintegration import tasks
+from slackintegration.fakeslack import FakeSlack
+from slackintegration.models import SlackIntegration, SlackUser, SlackScheduleMessage
+from collections import defaultdict
+from unittest import mock
+import json
+import random
+import time
+import uuid
+
+TEAM_ID = 'TBENCH'
+USER_ID = 'UBENCH'
+
+# share of each event type in a synthetic stream
+EVENT_MIX = [
+    ('message', 50),
+    ('reaction_added', 30),
+    ('channel_rename', 8),
+    ('member_joined_channel', 7),
+    ('pin_added', 5),
+]
+
+# actions that reaction_added events vote on
+SEED_ACTIONS = 50
+
+
+def synthetic_event(event_type, rng, n):
+    if event_type == 'message':
+        event = {'type': 'message', 'text': 'message %s' % n, 'channel': 'C0', 'user': USER_ID, 'ts': '%s.0' % n}
+    elif event_type == 'reaction_added':
+        event = {'type': 'reaction_added',
+                 'user': USER_ID,
+                 'reaction': rng.choice(['+1', '-1']),
+                 'item': {'type': 'message', 'channel': 'C0', 'ts': 'seed.%s' % rng.randrange(SEED_ACTIONS)}}
+    elif event_type == 'channel_rename':
+        event = {'type': 'channel_rename', 'channel': {'id': 'C0', 'name': 'renamed-%s' % n}}
+    elif event_type == 'member_joined_channel':
+        event = {'type': 'member_joined_channel', 'user': 'U%s' % n, 'channel': 'C0', 'inviter': USER_ID}
+    else:
+        event = {'type': 'pin_added', 'user': USER_ID, 'channel_id': 'C0',
+                 'item': {'type': 'message', 'message': {'ts': '%s.0' % n}}}
+    return {'type': 'event_callback', 'team_id': TEAM_ID, 'event_id': 'Ev%s' % uuid.uuid4().hex, 'event': event}
+
+
+def synthetic_stream(count, seed):
+    rng = random.Random(seed)
+    types = [event_type for event_type, weight in EVENT_MIX for _ in range(weight)]
+    return [synthetic_event(rng.choice(types), rng, n) for n in range(count)]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+class Command(BaseCommand):
+    help = ('Replay Slack events against the webhook in a test database, with a local fake Slack API, '
+            'and report throughput, ack latency and queries per event')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--events', type=int, default=500,
+                            help='Number of synthetic events to replay')
+        parser.add_argument('--replay', metavar='FILE',
+                            help='Replay recorded Events API payloads, one JSON object per line, instead')
+        parser.add_argument('--latency-ms', type=float, default=0.0,
+                            help='Latency the fake Slack API adds to every call')
+        parser.add_argument('--rate-limit', type=float, default=0.0,
+                            help='Fraction of fake Slack API calls answered with 429')
+        parser.add_argument('--slack-limits', action='store_true',
+                            help="Keep PolicyKit's own per-tier rate limiting (slow for large runs)")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--json', action='store_true',
+                            help='Print the results as JSON')
+
+    def handle(self, *args, **options):
+        if options['replay']:
+            with open(options['replay']) as f:
+                stream = [json.loads(line) for line in f if line.strip()]
+            for payload in stream:
+                # recorded events belong to whatever workspace they came from
+                payload['team_id'] = TEAM_ID
+        else:
+            stream = synthetic_stream(options['events'], options['seed'])
+        if not stream:
+            raise CommandError('no events to replay')
+
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        eager = app.conf.task_always_eager
+        app.conf.task_always_eager = True
+        try:
+            with FakeSlack(latency=options['latency_ms'] / 1000.0,
+                           rate_limit=options['rate_limit'],
+                           seed=options['seed']) as slack, \
+                    mock.patch.object(ratelimit, 'SHARE', 1.0 if options['slack_limits'] else 1000.0), \
+                    mock.patch.object(ratelimit, '_buckets', {}):
+                self.create_workspace()
+                results = self.run_benchmark(stream)
+                results['slack_calls'] = dict(slack.calls)
+                results['slack_rate_limited'] = dict(slack.rate_limited)
+        finally:
+            app.conf.task_always_eager = eager
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2, sort_keys=True))
+        else:
+            self.report(results)
+
+    def create_workspace(self):
+        group, _ = Group.objects.get_or_create(name='Slack')
+        integration = SlackIntegration.objects.create(community_name='bench',
+                                                      team_id=TEAM_ID,
+                                                      access_token='xoxb-bench',
+                                                      user_group=group)
+        user = SlackUser.objects.create(username=USER_ID,
+                                        password='password',
+                                        community_integration=integration,
+                                        user_id=USER_ID,
+                                        readable_name='bench',
+                                        access_token='xoxp-bench')
+        rule = RulePolicy.objects.create(community_integration=integration,
+                                         author=user,
+                                         rule_text='majority vote',
+                                         explanation='majority vote')
+        rule.status = Policy.PASSED
+        rule.save()
+        for n in range(SEED_ACTIONS):
+            SlackScheduleMessage.objects.create(community_integration=integration,
+                                                author=user,
+                                                community_post_id='seed.%s' % n,
+                                                text='seed',
+                                                channel='C0',
+                                                post_at=0)
+
+    def run_benchmark(self, stream):
+        client = Client()
+        queued = []
+        ack_latency = []
+        ack_queries = 0
+
+        # acknowledge everything first, the way the web process does
+        start = time.perf_counter()
+        with mock.patch.object(tasks.process_event, 'delay', queued.append):
+            for payload in stream:
+                body = json.dumps(payload)
+                with CaptureQueriesContext(connection) as queries:
+                    request_start = time.perf_counter()
+                    response = client.post('/slack/action', body, content_type='application/json')
+                    ack_latency.append(time.perf_counter() - request_start)
+                if response.status_code != 200:
+                    raise CommandError('webhook answered %s' % response.status_code)
+                ack_queries += len(queries)
+        ack_time = time.perf_counter() - start
+
+        # then process them, the way the slack queue worker does
+        by_type = defaultdict(list)
+        process_queries = 0
+        start = time.perf_counter()
+        for event_pk, payload in zip(queued, stream):
+            with CaptureQueriesContext(connection) as queries:
+                event_start = time.perf_counter()
+                tasks.process_event(event_pk)
+                by_type[payload['event'].get('type')].append(time.perf_counter() - event_start)
+            process_queries += len(queries)
+        process_time = time.perf_counter() - start
+
+        return {
+            'events': len(stream),
+            'ack': {'events_per_second': len(stream) / ack_time,
+                    'p50_ms': percentile(ack_latency, 0.5) * 1000,
+                    'p99_ms': percentile(ack_latency, 0.99) * 1000,
+                    'queries_per_event': ack_queries / len(stream),
+                    },
+            'process': {'events_per_second': len(queued) / process_time,
+                        'queries_per_event': process_queries / max(len(queued), 1),
+                        'by_type': {event_type: {'events': len(times),
+                                                 'p50_ms': percentile(times, 0.5) * 1000,
+                                                 'p99_ms': percentile(times, 0.99) * 1000,
+                                                 }
+                                    for event_type, times in by_type.items()},
+                        },
+        }
+
+    def report(self, results):
+        ack = results['ack']
+        process = results['process']
+        self.stdout.write('%s events' % results['events'])
+        self.stdout.write('ack:     %.1f events/s, p50 %.2fms, p99 %.2fms, %.1f queries/event' % (
+            ack['events_per_second'], ack['p50_ms'], ack['p99_ms'], ack['queries_per_event']))
+        self.stdout.write('process: %.1f events/s, %.1f queries/event' % (
+            process['events_per_second'], process['queries_per_event']))
+        for event_type, stats in sorted(process['by_type'].items()):
+            self.stdout.write('  %-22s %5s events, p50 %.2fms, p99 %.2fms' % (
+                event_type, stats['events'], stats['p50_ms'], stats['p99_ms']))
+        self.stdout.write('slack calls: %s' % ', '.join('%s=%s' % item for item in sorted(results['slack_calls'].items())))
+        if results['slack_rate_limited']:
+            self.stdout.write('rate limited: %s' % ', '.join('%s=%s' % item for item in sorted(results['slack_rate_limited'].items())))
@@ -1,12 +1,16 @@
+from django.conf import settings
+from django.core.cache import caches
 from django.db import models
 from policyengine.models import CommunityIntegration, CommunityUser, CommunityAction, Policy, RulePolicy
 from django.contrib.auth.models import Permission, ContentType, User
-import urllib
-import json
+from policyengine import api_client, permissions
 import logging
 
 logger = logging.getLogger(__name__)
 
+SLACK_CHANNEL_CACHE = getattr(settings, 'SLACK_CHANNEL_CACHE', 'default')
+SLACK_CHANNEL_CACHE_SECONDS = getattr(settings, 'SLACK_CHANNEL_CACHE_SECONDS', 3600)
+
 SLACK_ACTIONS = ['slackpostmessage', 
                  'slackschedulemessage', 
                  'slackrenameconversation',
@@ -15,6 +19,42 @@ SLACK_ACTIONS = ['slackpostmessage',
                  'slackpinmessage'
                  ]
 
+def channel_cache_key(team_id, channel):
+    return 'slack-channel:%s:%s' % (team_id, channel)
+
+
+def channel_cache():
+    # must be shared by all slack workers: the rename a revert causes is
+    # usually handled by another process
+    return caches[SLACK_CHANNEL_CACHE]
+
+
+class SlackEvent(models.Model):
+    # raw Events API payloads, stored before they are acknowledged and
+    # processed later by slackintegration.tasks.process_event
+    event_id = models.CharField('event_id', max_length=50, unique=True, null=True)
+    
+    team_id = models.CharField('team_id', max_length=150)
+    
+    event_type = models.CharField('event_type', max_length=50)
+    
+    payload = models.TextField()
+    
+    received_time = models.DateTimeField(auto_now_add=True)
+    
+    # set by the worker handling the event; a claim older than
+    # SLACK_EVENT_CLAIM_SECONDS belongs to a worker that died
+    claimed_time = models.DateTimeField(null=True, blank=True)
+    
+    attempts = models.PositiveSmallIntegerField(default=0)
+    
+    # set before the first Slack call made for the event; from then on a
+    # retry would repeat reverts and rule posts, so the event is not retried
+    sent_time = models.DateTimeField(null=True, blank=True)
+    
+    processed_time = models.DateTimeField(null=True, blank=True)
+    
+
 class SlackIntegration(CommunityIntegration):
     API = 'https://slack.com/api/'
     
@@ -27,10 +67,9 @@ class SlackIntegration(CommunityIntegration):
     def save(self, *args, **kwargs):      
         super(SlackIntegration, self).save(*args, **kwargs)
         
-        content_types = ContentType.objects.filter(model__in=SLACK_ACTIONS)
-        perms = Permission.objects.filter(content_type__in=content_types, name__contains="can add ")
-        for p in perms:
-            self.user_group.permissions.add(p)
+        # add() only inserts the permissions the group does not have yet
+        codenames = ['add_' + action for action in SLACK_ACTIONS]
+        self.user_group.permissions.add(*permissions.get_permission_ids('codename', codenames))
             
 
 class SlackUser(CommunityUser):
@@ -44,8 +83,7 @@ class SlackUser(CommunityUser):
     
     def save(self, *args, **kwargs):      
         super(SlackUser, self).save(*args, **kwargs)
-        group = self.community_integration.user_group
-        group.user_set.add(self)
+        self.groups.add(self.community_integration.user_group_id)
 
 
     
@@ -88,16 +126,26 @@ class SlackRenameConversation(CommunityAction):
     channel = models.CharField('channel', max_length=150)
     
     def get_channel_info(self):
+        key = channel_cache_key(self.community_integration.team_id, self.channel)
+        info = channel_cache().get(key)
+        if info is not None:
+            if info['name'] != self.name:
+                # this rename is news to the cache, so the cached name is now
+                # the most recent previous name
+                info = {'name': self.name,
+                        'previous_names': [info['name']] + info['previous_names']}
+                channel_cache().set(key, info, SLACK_CHANNEL_CACHE_SECONDS)
+            return info['previous_names']
+        
         values = {'token': self.community_integration.access_token,
                 'channel': self.channel
                 }
-        data = urllib.parse.urlencode(values)
-        data = data.encode('utf-8')
-        req = urllib.request.Request('https://slack.com/api/conversations.info?', data)
-        resp = urllib.request.urlopen(req)
-        res = json.loads(resp.read().decode('utf-8'))
-        logger.info(res)
+        res = api_client.api_call(SlackIntegration.API + 'conversations.info', values,
+                                  workspace=self.community_integration_id)
+        logger.debug('conversations.info for channel %s: %s', self.channel, 'ok' if res.get('ok') else res.get('error'))
         prev_names = res['channel']['previous_names']
+        channel_cache().set(key, {'name': res['channel']['name'], 'previous_names': prev_names},
+                            SLACK_CHANNEL_CACHE_SECONDS)
         return prev_names
         
     def revert(self, prev_name):
@@ -106,6 +154,14 @@ class SlackRenameConversation(CommunityAction):
                 'channel': self.channel
                 }
         super().revert(values, SlackIntegration.API + 'conversations.rename')
+        
+        # record the rename back the way Slack does, so the next rename is
+        # reverted to prev_name even before our own rename event arrives
+        key = channel_cache_key(self.community_integration.team_id, self.channel)
+        info = channel_cache().get(key)
+        if info is not None and info['name'] == self.name:
+            channel_cache().set(key, {'name': prev_name, 'previous_names': [self.name] + info['previous_names']},
+                                SLACK_CHANNEL_CACHE_SECONDS)
     
     def post_rule(self):
         values = {'channel': self.channel,
@@ -0,0 +1,143 @@
+from __future__ import absolute_import, unicode_literals
+
+from celery import shared_task
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+from datetime import timedelta
+from slackintegration.models import SlackEvent, SlackRenameConversation, SlackJoinConversation, SlackPostMessage, SlackPinMessage
+from slackintegration import lookups
+from policyengine import api_client, metrics
+from policyengine.models import ActionPolicy, UserVote, CommunityAction
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+CLAIM = timedelta(seconds=getattr(settings, 'SLACK_EVENT_CLAIM_SECONDS', 300))
+MAX_ATTEMPTS = getattr(settings, 'SLACK_EVENT_MAX_ATTEMPTS', 5)
+
+PROCESS_SECONDS = metrics.histogram('policykit_slack_event_process_seconds',
+                                    'Time to handle a stored Slack event on the slack queue',
+                                    ['event_type'])
+
+
+def unprocessed_events(now):
+    # not handled yet, not claimed by a live worker and safe to retry
+    return SlackEvent.objects.filter(Q(claimed_time__isnull=True) | Q(claimed_time__lt=now - CLAIM),
+                                     processed_time__isnull=True,
+                                     sent_time__isnull=True)
+
+
+@shared_task
+def process_event(event_pk):
+    # claim the event first so two workers never handle it at the same time
+    now = timezone.now()
+    claimed = unprocessed_events(now).filter(pk=event_pk).update(claimed_time=now, attempts=F('attempts') + 1)
+    if not claimed:
+        return
+
+    def sending():
+        SlackEvent.objects.filter(pk=event_pk).update(sent_time=timezone.now())
+
+    # no transaction around the handler: it waits on Slack and the rate
+    # limits, and a rollback would not undo what Slack already did
+    slack_event = SlackEvent.objects.get(pk=event_pk)
+    try:
+        with PROCESS_SECONDS.time(event_type=slack_event.event_type), api_client.on_first_call(sending):
+            handle_event(json.loads(slack_event.payload))
+    except Exception:
+        # give the event back; requeue_unprocessed_events retries it unless
+        # it already reached Slack
+        SlackEvent.objects.filter(pk=event_pk).update(claimed_time=None)
+        if SlackEvent.objects.filter(pk=event_pk, sent_time__isnull=False).exists():
+            logger.error('Slack event %s failed after calling Slack and is not retried', slack_event.event_id)
+        raise
+    SlackEvent.objects.filter(pk=event_pk).update(processed_time=timezone.now())
+
+
+@shared_task
+def requeue_unprocessed_events():
+    # picks up events whose process_event task was lost (broker outages),
+    # failed, or whose worker died while handling them, before any of them
+    # called Slack
+    now = timezone.now()
+    events = unprocessed_events(now).filter(received_time__lt=now - timedelta(minutes=5))
+    for event_pk in events.filter(attempts__lt=MAX_ATTEMPTS).values_list('pk', flat=True):
+        process_event.delay(event_pk)
+    
+    given_up = list(events.filter(attempts=MAX_ATTEMPTS).values_list('event_id', flat=True))
+    if given_up:
+        # counted past MAX_ATTEMPTS so they are reported only once
+        events.filter(attempts=MAX_ATTEMPTS).update(attempts=F('attempts') + 1)
+        logger.error('giving up on Slack events after %s attempts: %s', MAX_ATTEMPTS, ', '.join(given_up))
+
+
+def handle_event(json_data):
+    event = json_data.get('event')
+    team_id = json_data.get('team_id')
+    integration = lookups.get_integration(team_id)
+    author = lookups.get_default_author()
+#     author_id = json_data.get('authed_users')[0]
+
+    if event.get('type') == "channel_rename":
+
+        new_action = SlackRenameConversation()
+        new_action.community_integration = integration
+        new_action.author = author
+        new_action.name = event['channel']['name']
+        new_action.channel = event['channel']['id']
+        new_action.save(slack_revert=True)
+
+    elif event.get('type') == "member_joined_channel":
+        new_action = SlackJoinConversation()
+        new_action.community_integration = integration
+        inviter_user = event.get('inviter')
+        new_action.author = author
+        new_action.users = event.get('user')
+        new_action.channel = event['channel']
+        new_action.save(slack_revert=True, inviter=inviter_user)
+
+    elif event.get('type') == 'message':
+        if event.get('subtype') == None:
+            new_action = SlackPostMessage()
+            new_action.community_integration = integration
+            new_action.author = author
+            new_action.text = event['text']
+            new_action.channel = event['channel']
+            time_stamp = event['ts']
+            poster = event['user']
+            new_action.save(time_stamp=time_stamp, poster=poster)
+
+    elif event.get('type') == 'pin_added':
+        new_action = SlackPinMessage()
+        new_action.community_integration = integration
+        new_action.author = author
+        new_action.channel = event['channel_id']
+        new_action.timestamp = event['item']['message']['ts']
+        user = event['user']
+        new_action.save(user=user)
+
+    elif event.get('type') == 'reaction_added':
+        ts = event['item']['ts']
+        action = CommunityAction.objects.non_polymorphic().filter(community_integration=integration,
+                                                                  community_post_id=ts).first()
+        if action:
+            policy_id = action.action_policy_id
+            if policy_id is None:
+                # actions created before the direct link existed
+                policy_id = ActionPolicy.objects.filter(content_type=action.polymorphic_ctype_id,
+                                                        object_id=action.id).values_list('pk', flat=True).first()
+            if policy_id:
+                if event['reaction'] == '+1' or event['reaction'] == '-1':
+                    if event['reaction'] == '+1':
+                        value = True
+                    elif event['reaction'] == '-1':
+                        value = False
+
+                    user = lookups.get_user(event['user'])
+                    # one save, so a new vote is counted once and not as an
+                    # abstention first
+                    UserVote.objects.update_or_create(policy_id=policy_id,
+                                                      user=user,
+                                                      defaults={'value': value})
@@ -1,3 +1,185 @@
-from django.test import TestCase
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from policyengine import api_client
+from django.db import OperationalError
+from django.test import Client, TestCase
+from django.utils import timezone
+from policyengine.models import Policy, VOTES
+from slackintegration import tasks
+from slackintegration.fakeslack import FakeSlack
+from slackintegration.models import channel_cache, SlackEvent, SlackIntegration, SlackUser, SlackPostMessage, SlackScheduleMessage
+from unittest import mock
+import json
 
-# Create your tests here.
+
+class ProcessEventTest(TestCase):
+
+    def add_event(self, team_id):
+        payload = {'type': 'event_callback', 'team_id': team_id, 'event_id': 'Ev1',
+                   'event': {'type': 'channel_rename', 'channel': {'id': 'C1', 'name': 'renamed'}}}
+        return SlackEvent.objects.create(event_id='Ev1', team_id=team_id, event_type='channel_rename',
+                                         payload=json.dumps(payload))
+
+    def test_failed_event_is_left_for_requeue(self):
+        event = self.add_event('TUNKNOWN')
+        with self.assertRaises(Exception):
+            tasks.process_event(event.pk)
+
+        event.refresh_from_db()
+        self.assertIsNone(event.processed_time)
+        self.assertIsNone(event.claimed_time)
+        self.assertEqual(event.attempts, 1)
+        self.assertTrue(tasks.unprocessed_events(timezone.now()).filter(pk=event.pk).exists())
+
+    def test_event_that_reached_slack_is_not_retried(self):
+        group = Group.objects.create(name='Slack')
+        integration = SlackIntegration.objects.create(community_name='community',
+                                                      team_id='T0',
+                                                      access_token='xoxb-0',
+                                                      user_group=group)
+        SlackUser.objects.create(username='U0',
+                                 password='password',
+                                 community_integration=integration,
+                                 user_id='U0',
+                                 readable_name='user',
+                                 access_token='xoxp-0')
+        payload = {'type': 'event_callback', 'team_id': 'T0', 'event_id': 'Ev2',
+                   'event': {'type': 'message', 'text': 'hi', 'channel': 'C1', 'user': 'U1', 'ts': '2.0'}}
+        event = SlackEvent.objects.create(event_id='Ev2', team_id='T0', event_type='message',
+                                          payload=json.dumps(payload))
+
+        # the message is deleted, then posting the rule fails
+        with FakeSlack() as slack, \
+                mock.patch.object(SlackPostMessage, 'post_rule', side_effect=RuntimeError('post failed')), \
+                self.assertRaises(RuntimeError):
+            tasks.process_event(event.pk)
+        self.assertEqual(slack.calls['chat.delete'], 1)
+
+        event.refresh_from_db()
+        self.assertIsNone(event.processed_time)
+        self.assertIsNotNone(event.sent_time)
+        self.assertFalse(tasks.unprocessed_events(timezone.now()).filter(pk=event.pk).exists())
+
+
+class ReactionVoteTest(TestCase):
+
+    def setUp(self):
+        group = Group.objects.create(name='Slack')
+        self.integration = SlackIntegration.objects.create(community_name='community',
+                                                           team_id='T0',
+                                                           access_token='xoxb-0',
+                                                           user_group=group)
+        user = SlackUser.objects.create(username='U0',
+                                        password='password',
+                                        community_integration=self.integration,
+                                        user_id='U0',
+                                        readable_name='user',
+                                        access_token='xoxp-0')
+        self.message = SlackScheduleMessage.objects.create(community_integration=self.integration,
+                                                           author=user,
+                                                           community_post_id='1.0',
+                                                           text='hello',
+                                                           channel='C1',
+                                                           post_at=0)
+
+    def react(self, reaction):
+        tasks.handle_event({'type': 'event_callback', 'team_id': 'T0',
+                            'event': {'type': 'reaction_added', 'user': 'U0', 'reaction': reaction,
+                                      'item': {'type': 'message', 'channel': 'C1', 'ts': '1.0'}}})
+        return Policy.objects.get(pk=self.message.action_policy_id)
+
+    def test_reaction_is_counted_once(self):
+        yes_votes = VOTES.values.get(('yes',), 0)
+        policy = self.react('+1')
+        self.assertEqual((policy.yes_votes, policy.no_votes, policy.abstain_votes), (1, 0, 0))
+        self.assertEqual(policy.tally_version, 1)
+        self.assertEqual(VOTES.values.get(('yes',), 0), yes_votes + 1)
+
+        policy = self.react('-1')
+        self.assertEqual((policy.yes_votes, policy.no_votes, policy.abstain_votes), (0, 1, 0))
+        self.assertEqual(policy.tally_version, 2)
+
+
+class StoreEventTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        patcher = mock.patch.object(tasks.process_event, 'delay')
+        self.delay = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, event_id='Ev3'):
+        payload = {'type': 'event_callback', 'team_id': 'T0', 'event_id': event_id,
+                   'event': {'type': 'message', 'text': 'hi', 'channel': 'C1', 'user': 'U1', 'ts': '3.0'}}
+        return Client().post('/slack/action', json.dumps(payload), content_type='application/json')
+
+    def assertStoredOnce(self):
+        self.assertEqual(SlackEvent.objects.filter(event_id='Ev3').count(), 1)
+        self.delay.assert_called_once_with(SlackEvent.objects.get(event_id='Ev3').pk)
+
+    def test_redelivery_is_dropped_by_the_cache(self):
+        self.assertEqual(self.post().status_code, 200)
+        self.assertEqual(self.post().status_code, 200)
+        self.assertStoredOnce()
+
+    def test_redelivery_is_dropped_by_the_unique_constraint(self):
+        self.post()
+        # another process, or the cache entry expired
+        cache.clear()
+        self.assertEqual(self.post().status_code, 200)
+        self.assertStoredOnce()
+
+    def test_failed_insert_lets_the_retry_through(self):
+        with mock.patch.object(SlackEvent.objects, 'create', side_effect=OperationalError('database is locked')), \
+                self.assertRaises(OperationalError):
+            self.post()
+        self.post()
+        self.assertStoredOnce()
+
+
+class ChannelRenameTest(TestCase):
+
+    def setUp(self):
+        channel_cache().clear()
+        group = Group.objects.create(name='Slack')
+        integration = SlackIntegration.objects.create(community_name='community',
+                                                      team_id='T0',
+                                                      access_token='xoxb-0',
+                                                      user_group=group)
+        SlackUser.objects.create(username='U0',
+                                 password='password',
+                                 community_integration=integration,
+                                 user_id='U0',
+                                 readable_name='user',
+                                 access_token='xoxp-0')
+        # the channel as Slack sees it
+        self.channel = {'name': 'a', 'previous_names': []}
+        self.reverted_to = []
+
+    def fake_api_call(self, url, values, workspace=None):
+        method = url.rsplit('/', 1)[-1]
+        if method == 'conversations.info':
+            return {'ok': True, 'channel': {'name': self.channel['name'],
+                                            'previous_names': list(self.channel['previous_names'])}}
+        if method == 'conversations.rename':
+            self.reverted_to.append(values['name'])
+            self.rename(values['name'])
+        return {'ok': True}
+
+    def rename(self, name):
+        self.channel['previous_names'].insert(0, self.channel['name'])
+        self.channel['name'] = name
+
+    def user_renames(self, name):
+        self.rename(name)
+        with mock.patch.object(api_client, 'api_call', self.fake_api_call):
+            tasks.handle_event({'type': 'event_callback', 'team_id': 'T0',
+                                'event': {'type': 'channel_rename', 'channel': {'id': 'C1', 'name': name}}})
+
+    def test_second_rename_is_reverted_to_the_accepted_name(self):
+        self.user_renames('b')
+        # the event for our own rename back to 'a' goes to another worker
+        self.user_renames('c')
+        self.assertEqual(self.reverted_to, ['a', 'a'])
+        self.assertEqual(self.channel['name'], 'a')
@@ -1,36 +1,44 @@
 from django.shortcuts import render
-from django.http import HttpResponse
-from urllib import parse
-import urllib.request
+from django.http import HttpResponse, HttpResponseBadRequest
 from policykit.settings import CLIENT_SECRET
+from policyengine import api_client, metrics
 from django.contrib.auth import login, authenticate
 import logging
 from django.shortcuts import redirect
 import json
-from slackintegration.models import SlackIntegration, SlackUser, SlackRenameConversation, SlackJoinConversation, SlackPostMessage, SlackPinMessage
-from policyengine.models import ActionPolicy, UserVote, CommunityAction
+import time
+from slackintegration.models import SlackEvent, SlackIntegration, SlackUser
+from slackintegration.tasks import process_event
 from django.contrib.auth.models import User, Group
 from django.views.decorators.csrf import csrf_exempt
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.conf import settings
 
 logger = logging.getLogger(__name__)
 
+SLACK_EVENT_DEDUP_SECONDS = getattr(settings, 'SLACK_EVENT_DEDUP_SECONDS', 3600)
+
+ACK_SECONDS = metrics.histogram('policykit_slack_event_ack_seconds',
+                                'Time to accept an incoming Slack event and answer the webhook',
+                                ['event_type'])
+
 # Create your views here.
 
 def oauth(request):
     code = request.GET.get('code')
     state = request.GET.get('state')
     
-    data = parse.urlencode({
+    data = {
         'client_id': '455205644210.932801604965',
         'client_secret': CLIENT_SECRET,
         'code': code,
-        }).encode()
+        }
         
-    req = urllib.request.Request('https://slack.com/api/oauth.v2.access', data=data)
-    resp = urllib.request.urlopen(req)
-    res = json.loads(resp.read().decode('utf-8'))
+    res = api_client.api_call(SlackIntegration.API + 'oauth.v2.access', data)
     
-    logger.info(res)
+    # the response carries access tokens, so never log it whole
+    logger.info('oauth.v2.access for %s install: %s', state, 'ok' if res['ok'] else res.get('error'))
     
     if res['ok']:
         if state =="user": 
@@ -62,80 +70,72 @@ def oauth(request):
     return response
 
 
-@csrf_exempt
-def action(request):
-    json_data = json.loads(request.body)
-    logger.info(json_data)
+def parse_action(body):
+    """
+    Check an incoming Slack request. Returns (response, json_data): either
+    a response to send straight back, or an event_callback to store.
+    """
+    try:
+        json_data = json.loads(body)
+    except ValueError:
+        return HttpResponseBadRequest(), None
     
     action_type = json_data.get('type')
+    logger.debug('received %s %s', action_type, json_data.get('event_id'))
     
     if action_type == "url_verification":
         challenge = json_data.get('challenge')
-        return HttpResponse(challenge)
+        return HttpResponse(challenge), None
     elif action_type == "event_callback":
         event = json_data.get('event')
         team_id = json_data.get('team_id')
-        integration = SlackIntegration.objects.get(team_id=team_id)
-        author = SlackUser.objects.all()[0] # TODO Change this to admin user? Bot user?
-#         author_id = json_data.get('authed_users')[0]
-
-        if event.get('type') == "channel_rename":
-            
-            new_action = SlackRenameConversation()
-            new_action.community_integration = integration
-            new_action.author = author
-            new_action.name = event['channel']['name']
-            new_action.channel = event['channel']['id']
-            new_action.save(slack_revert=True)
-    
-        elif event.get('type') == "member_joined_channel":
-            new_action = SlackJoinConversation()
-            new_action.community_integration = integration
-            inviter_user = event.get('inviter')
-            new_action.author = author
-            new_action.users = event.get('user')
-            new_action.channel = event['channel']
-            new_action.save(slack_revert=True, inviter=inviter_user)
+        if not team_id or not isinstance(event, dict):
+            return HttpResponseBadRequest(), None
+        return None, json_data
     
-        elif event.get('type') == 'message':
-            if event.get('subtype') == None:
-                new_action = SlackPostMessage()
-                new_action.community_integration = integration
-                new_action.author = author
-                new_action.text = event['text']
-                new_action.channel = event['channel']
-                time_stamp = event['ts']
-                poster = event['user']
-                new_action.save(time_stamp=time_stamp, poster=poster)
+    return HttpResponse(""), None
 
-        elif event.get('type') == 'pin_added':
-            new_action = SlackPinMessage()
-            new_action.community_integration = integration
-            new_action.author = author
-            new_action.channel = event['channel_id']
-            new_action.timestamp = event['item']['message']['ts']
-            user = event['user']
-            new_action.save(user=user)
-            
-        elif event.get('type') == 'reaction_added':
-            ts = event['item']['ts']
-            action = CommunityAction.objects.filter(community_post_id=ts)
-            if action:
-                action = action[0]
-                policy = ActionPolicy.objects.filter(object_id=action.id)
-                if policy:
-                    policy = policy[0]
-                    if event['reaction'] == '+1' or event['reaction'] == '-1':
-                        if event['reaction'] == '+1':
-                            value = True
-                        elif event['reaction'] == '-1':
-                            value = False
-                        
-                        user = SlackUser.objects.get(user_id=event['user'])
-                        uv, created = UserVote.objects.get_or_create(policy=policy,
-                                                                     user=user)
-                        uv.value = value
-                        uv.save()
+
+def store_event(json_data, body, retry_num):
+    """
+    Persist an event_callback and queue it for processing, unless it is a
+    redelivery of an event that was already accepted.
+    """
+    event_id = json_data.get('event_id')
     
-    return HttpResponse("")
+    # Slack redelivers slow events, so each event_id is only accepted
+    # once: the cache turns retries away cheaply, the unique constraint
+    # catches whatever gets past it
+    dedup_key = 'slack-event:%s' % event_id
+    if event_id and not cache.add(dedup_key, True, SLACK_EVENT_DEDUP_SECONDS):
+        logger.info('dropping duplicate event %s (retry %s)', event_id, retry_num)
+        return
     
+    # acknowledge within Slack's 3 second window and do the work
+    # (reverts, rule posts, evaluation) on the slack queue
+    try:
+        with transaction.atomic():
+            slack_event = SlackEvent.objects.create(event_id=event_id,
+                                                    team_id=json_data['team_id'],
+                                                    event_type=json_data['event'].get('type') or '',
+                                                    payload=body.decode('utf-8'))
+    except IntegrityError:
+        logger.info('dropping duplicate event %s (retry %s)', event_id, retry_num)
+        return
+    except Exception:
+        # let Slack's retry through instead of dropping the event
+        cache.delete(dedup_key)
+        raise
+    process_event.delay(slack_event.pk)
+
+
+@csrf_exempt
+def action(request):
+    # the ASGI entry point serves this path with slackintegration.asgi.action
+    start = time.perf_counter()
+    response, json_data = parse_action(request.body)
+    if response is None:
+        store_event(json_data, request.body, request.META.get('HTTP_X_SLACK_RETRY_NUM'))
+        response = HttpResponse("")
+        ACK_SECONDS.observe(time.perf_counter() - start, event_type=json_data['event'].get('type'))
+    return response